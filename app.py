@@ -1,17 +1,47 @@
 import json
 import asyncio
-import threading
-from flask import Flask
+import time
+from flask import Flask, g, request
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from lab13.lab13 import lab_13
 from lab14.lab14 import lab_14
 from poll_params import poll_params
+from history_api import history_api
+from stream import stream
+from snapshot import snapshot
+from burst import burst
+from metrics import metrics, http_request_seconds
+from workers import workers
+from traffic_capture import traffic
 from scheduler import configure_scheduler
+from modbus_service import modbus_service
 
 app = Flask(__name__)
 app.register_blueprint(lab_13)
 app.register_blueprint(lab_14)
 app.register_blueprint(poll_params)
+app.register_blueprint(history_api)
+app.register_blueprint(stream)
+app.register_blueprint(snapshot)
+app.register_blueprint(burst)
+app.register_blueprint(metrics)
+app.register_blueprint(workers)
+app.register_blueprint(traffic)
+
+
+# Время обработки запросов REST по маршрутам для /metrics
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    started = g.get("started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        http_request_seconds.labels(route, request.method, response.status_code).observe(time.perf_counter() - started)
+    return response
 
 # Подгружаем настройки из файла
 with open('config.json') as f:
@@ -35,18 +65,12 @@ async def run_scheduler():
         scheduler.shutdown()
 
 
-# Функция для запуска асинхронного цикла в отдельном потоке
-def start_scheduler_in_thread(loop):
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(run_scheduler())
-
-
-# Запускаем планировщик в фоновом потоке при старте приложения
+# Запускаем планировщик в цикле событий Modbus-сервиса при старте приложения
 def start_app():
-    # Создаем новый цикл событий для планировщика
-    scheduler_loop = asyncio.new_event_loop()
-    scheduler_thread = threading.Thread(target=start_scheduler_in_thread, args=(scheduler_loop,), daemon=True)
-    scheduler_thread.start()
+    # Планировщик и обработчики Flask используют один цикл событий,
+    # поэтому блокировки устройств действительно упорядочивают обмен
+    modbus_service.start()
+    modbus_service.submit(run_scheduler())
 
     # Запускаем Flask
     app.run(debug=False, port=d["port"])
@@ -0,0 +1,315 @@
+import asyncio
+import contextvars
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+from werkzeug.exceptions import HTTPException, NotFound, MethodNotAllowed
+from app import app, scheduler
+from lab13.lab13 import Lab13API
+from lab14.lab14 import Lab14API
+from device_profiles import lab_devices, endpoint_param, param_max_age
+from metrics import http_request_seconds
+from modbus_service import modbus_service
+from snapshot import snapshot_names, snapshot_values
+from value_cache import value_cache
+from workers import worker_role
+
+# Запуск в режиме ASGI: python3 asgi.py или uvicorn asgi:application --port 3001 [--workers n].
+# Сервер ASGI сам держит keep-alive и тысячи соединений, а обмен с приборами
+# идет в его же цикле событий: запросы к приборам и снимки выполняются как корутины без потоков,
+# остальные маршруты Flask - в пуле потоков.
+# При нескольких рабочих процессах опрос и обмен с приборами ведет один из них (workers.WorkerRole),
+# остальные отвечают из общей таблицы значений и пересылают ему запросы к приборам
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+# Ресурсы лабораторных работ: класс, номер работы, прибор для записи и тип записываемого значения
+LAB_RESOURCES = {
+    "lab13.lab13api": (Lab13API, "lab13", "trm202", str),
+    "lab14.lab14api": (Lab14API, "lab14", "trm210", int)
+}
+
+# Маршруты, которые в режиме нескольких процессов обслуживает только процесс опроса:
+# захват, статистика опроса и метрики относятся к обмену с приборами
+OWNER_BLUEPRINTS = {"burst", "poll_params", "metrics", "traffic"}
+
+
+class _Response(Exception):
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+
+# Запрос требует обмена с приборами, а опрос ведет другой процесс
+class _Forward(Exception):
+    pass
+
+
+def _json_response(status, data):
+    body = (json.dumps(data) + "\n").encode()
+    return status, [["content-type", "application/json"], ["content-length", str(len(body))]], body
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+# Заголовок пересылаемого запроса: все, что нужно процессу опроса, чтобы выполнить его как свой
+def _forward_header(scope):
+    return {"method": scope["method"], "path": scope["path"], "query_string": scope["query_string"].decode("latin-1"),
+            "headers": [[name.decode("latin-1"), value.decode("latin-1")] for name, value in scope["headers"]]}
+
+
+def _query_value(query, name, type_, default=None):
+    values = query.get(name)
+    if not values:
+        return default
+    try:
+        return type_(values[-1])
+    except ValueError as e:
+        raise _Response(400, {"message": {name: str(e)}})
+
+
+# Чтение значения прибора: из кэша опроса или с прибора, как Lab13API.get / Lab14API.get
+async def _lab_get(resource_class, lab_num, view_args, query):
+    device, function = view_args["device"], view_args["function"]
+    resource = resource_class()
+    if device not in lab_devices(lab_num):
+        raise _Response(404, {"message": "Нет устройства {} в {}".format(device, lab_num)})
+    max_age = _query_value(query, "max_age", float)
+    spec = endpoint_param(lab_num, device, function)
+    sample = value_cache.get(spec.name, param_max_age(spec.name, max_age)) if spec else None
+    if sample:
+        return resource._result(device, function, sample.value, sample.timestamp, True)
+    if worker_role.forwarding:
+        raise _Forward()
+    return await resource._read_device_data(device, function)
+
+
+async def _lab_post(resource_class, lab_num, write_device, value_type, view_args, query):
+    device, function = view_args["device"], view_args["function"]
+    if device != write_device:
+        raise _Response(404, {"message": "Нет устройства {} в {}".format(device, lab_num)})
+    if worker_role.forwarding:
+        raise _Forward()
+    value = _query_value(query, "value", value_type)
+    return await resource_class()._write_device_data(device, function, value)
+
+
+async def _snapshot_get(view_args, query):
+    lab = view_args["lab"]
+    names = snapshot_names(lab, (query.get("params") or [None])[-1])
+    max_age = _query_value(query, "max_age", float)
+    if worker_role.forwarding and any(value_cache.get(name, param_max_age(name, max_age)) is None for name in names):
+        raise _Forward()
+    return await snapshot_values(lab, names, max_age)
+
+
+# Приложение ASGI: маршруты обмена с приборами обрабатываются корутинами в цикле событий сервера,
+# остальные передаются приложению Flask (WSGI) в пуле потоков
+class ModbusASGI:
+    def __init__(self, flask_app, threads):
+        self.flask_app = flask_app
+        self.url_map = flask_app.url_map
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Сервис Modbus и планировщик опроса работают в цикле событий сервера ASGI.
+                # Планировщик запускает только процесс, занявший роль процесса опроса
+                modbus_service.attach(asyncio.get_running_loop())
+                await worker_role.start(scheduler.start, self._forwarded)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await worker_role.stop()
+                if scheduler.running:
+                    scheduler.shutdown(wait=False)
+                await modbus_service.detach()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        started = time.perf_counter()
+        adapter = self.url_map.bind("localhost")
+        try:
+            rule, view_args = adapter.match(scope["path"], scope["method"], return_rule=True)
+        except (NotFound, MethodNotAllowed):
+            rule = None
+        if rule is not None and worker_role.forwarding and rule.endpoint.split(".")[0] in OWNER_BLUEPRINTS:
+            status, headers, body = await worker_role.forward(_forward_header(scope), await _read_body(receive))
+            await self._send(send, status, headers, body)
+            return
+        handler = self._native_handler(rule, scope["method"]) if rule else None
+        if handler is None:
+            await self._wsgi(scope, receive, send)
+            return
+
+        query = parse_qs(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        try:
+            status, headers, body = _json_response(
+                200, await asyncio.wait_for(handler(view_args, query), d["service_request_timeout"]))
+        except _Forward:
+            status, headers, body = await worker_role.forward(_forward_header(scope))
+        except _Response as e:
+            status, headers, body = _json_response(e.status, e.data)
+        except HTTPException as e:
+            status, headers, body = _json_response(e.code, getattr(e, "data", None) or {"message": e.description})
+        except asyncio.TimeoutError:
+            status, headers, body = _json_response(504, {"message": "Превышено время ожидания ответа приборов"})
+        except Exception as e:
+            status, headers, body = _json_response(500, {"message": f"Unexpected error: {str(e)}"})
+        await self._send(send, status, headers, body)
+        http_request_seconds.labels(rule.rule, scope["method"], status).observe(time.perf_counter() - started)
+
+    @staticmethod
+    async def _send(send, status, headers, body):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers]})
+        await send({"type": "http.response.body", "body": body})
+
+    # Выполнение запроса, пересланного другим процессом: ответ собирается целиком
+    async def _forwarded(self, header, body):
+        scope = {"type": "http", "method": header["method"], "path": header["path"],
+                 "query_string": header["query_string"].encode("latin-1"), "root_path": "",
+                 "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in header["headers"]]}
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        response = {"status": 500, "headers": [], "body": []}
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            # Клиент пересланного запроса не отключается, ожидание отменит обработчик
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [[name.decode("latin-1"), value.decode("latin-1")]
+                                       for name, value in message["headers"]]
+            else:
+                response["body"].append(message.get("body", b""))
+
+        await self._http(scope, receive, send)
+        return response["status"], response["headers"], b"".join(response["body"])
+
+    @staticmethod
+    def _native_handler(rule, method):
+        if rule.endpoint in LAB_RESOURCES:
+            resource_class, lab_num, write_device, value_type = LAB_RESOURCES[rule.endpoint]
+            if method == "GET":
+                return lambda view_args, query: _lab_get(resource_class, lab_num, view_args, query)
+            if method == "POST":
+                return lambda view_args, query: _lab_post(resource_class, lab_num, write_device, value_type,
+                                                          view_args, query)
+        elif rule.endpoint == "snapshot.snapshotapi" and method == "GET":
+            return _snapshot_get
+        return None
+
+    # Передача запроса приложению Flask: вызов и чтение ответа выполняются в пуле потоков,
+    # ответ отправляется по частям, поэтому поток /stream работает и через этот путь.
+    # Части ответа могут читаться разными потоками пула, поэтому все вызовы идут в одном контексте
+    # запроса: контекст Flask хранится в contextvars
+    async def _wsgi(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body = await _read_body(receive)
+
+        disconnected = asyncio.Event()
+
+        async def wait_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(wait_disconnect())
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start["status"] = int(status.split(" ", 1)[0])
+            response_start["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                         for name, value in headers]
+
+        def call_app():
+            return iter(self.flask_app(self._environ(scope, body), start_response))
+
+        context = contextvars.copy_context()
+        try:
+            result = await loop.run_in_executor(self.executor, context.run, call_app)
+            started = False
+            try:
+                while not disconnected.is_set():
+                    chunk = await loop.run_in_executor(self.executor, context.run, next, result, None)
+                    if not started:
+                        await send({"type": "http.response.start", "status": response_start["status"],
+                                    "headers": response_start["headers"]})
+                        started = True
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                if started and not disconnected.is_set():
+                    await send({"type": "http.response.body", "body": b""})
+            finally:
+                if hasattr(result, "close"):
+                    await loop.run_in_executor(self.executor, context.run, result.close)
+        finally:
+            watcher.cancel()
+
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+                environ[name] = value
+            else:
+                key = f"HTTP_{name}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+
+application = ModbusASGI(app, d["asgi_wsgi_threads"])
+
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("Для режима ASGI установите uvicorn: pip install uvicorn")
+    uvicorn.run(application, host=d["asgi_host"], port=d["port"], log_level="warning")
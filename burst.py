@@ -0,0 +1,232 @@
+import asyncio
+import itertools
+import json
+import math
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from flask import Blueprint, Response
+from flask_restful import Api, Resource, abort, reqparse
+from device_profiles import device_params
+from interlocks import interlock_engine
+from locks import device_locks
+from modbus_pool import device_pool
+from modbus_service import modbus_service
+from read_plan import compile_plan, execute_request, slice_registers
+from value_cache import value_cache
+
+burst = Blueprint('burst', __name__)
+api = Api(burst)
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+
+# Кольцевой буфер значений с заранее выделенной памятью: время и по столбцу на каждый параметр.
+# При заполнении новые строки записываются на место самых старых
+class RingBuffer:
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.columns = columns
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = [array('d', bytes(8 * capacity)) for _ in columns]
+        self.count = 0   # всего записанных строк
+        self._next = 0
+
+    def append(self, timestamp, values):
+        self.timestamps[self._next] = timestamp
+        for column, value in zip(self.values, values):
+            column[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    # Номера строк буфера от самой старой к самой новой
+    def _order(self):
+        if self.count <= self.capacity:
+            return range(self.count)
+        return itertools.chain(range(self._next, self.capacity), range(self._next))
+
+    # Строки подряд в виде массива float64: время, значения параметров
+    def to_array(self):
+        result = array('d')
+        for i in self._order():
+            result.append(self.timestamps[i])
+            result.extend(column[i] for column in self.values)
+        return result
+
+    def to_csv(self):
+        lines = [",".join(["ts"] + self.columns)]
+        for i in self._order():
+            lines.append(",".join([repr(self.timestamps[i])] + [repr(column[i]) for column in self.values]))
+        return "\n".join(lines) + "\n"
+
+
+# Захват значений параметров с высокой частотой в кольцевой буфер, без записи в базы данных.
+# Чтения идут по расписанию от момента старта; пропущенные из-за медленного ответа моменты не догоняются
+class BurstCapture:
+    def __init__(self, capture_id, specs, rate_hz, seconds):
+        self.id = capture_id
+        self.specs = specs
+        self.rate_hz = rate_hz
+        self.seconds = seconds
+        self.plan = compile_plan(specs, gap_tolerance=d["read_gap_tolerance"])
+        self.buffer = RingBuffer(math.ceil(rate_hz * seconds), [spec.name for spec in specs])
+        self.state = "pending"
+        self.started = None
+        self.missed = 0   # моменты чтения, пропущенные из-за медленных ответов
+        self.errors = 0   # неудачные запросы, значения параметров записываются как NaN
+        self.task = None  # задача захвата в цикле событий modbus_service
+
+    async def run(self):
+        self.task = asyncio.current_task()
+        self.state = "running"
+        self.started = time.time()
+        period = 1 / self.rate_hz
+        start = time.monotonic()
+        try:
+            for tick in range(self.buffer.capacity):
+                delay = start + tick * period - time.monotonic()
+                if delay < 0 and tick:
+                    self.missed += 1
+                    continue
+                await asyncio.sleep(max(delay, 0))
+                values = {}
+                for request in self.plan:
+                    device = request.params[0].device
+                    try:
+                        async with device_locks[device], device_pool(device).connection() as client:
+                            data = await execute_request(client, request)
+                        if data.isError():
+                            self.errors += 1
+                            continue
+                    except Exception:
+                        self.errors += 1
+                        continue
+                    timestamp = time.time()
+                    for spec, registers in slice_registers(request, data.registers):
+                        value = spec.decode(registers)
+                        values[spec.name] = value
+                        interlock_engine.on_sample(spec.name, value, timestamp)
+                        value_cache.update(spec.name, value, timestamp)
+                self.buffer.append(time.time(), [values.get(spec.name, math.nan) for spec in self.specs])
+            self.state = "done"
+        except asyncio.CancelledError:
+            self.state = "stopped"
+            raise
+
+    # Остановка захвата из цикла событий modbus_service, в том числе еще не начавшегося
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.state == "pending":
+            self.state = "stopped"
+
+    def status(self):
+        return {"id": self.id, "params": self.buffer.columns, "rate_hz": self.rate_hz, "seconds": self.seconds,
+                "state": self.state, "started": self.started, "samples": len(self.buffer), "missed": self.missed,
+                "errors": self.errors}
+
+
+# Учет захватов: хранятся последние burst_keep завершенных
+class BurstManager:
+    def __init__(self, keep):
+        self.keep = keep
+        self.captures = OrderedDict()
+        self._ids = itertools.count(1)
+
+    # Новый захват; запускать его корутину run() должен вызывающий, в цикле событий modbus_service
+    def create(self, param_names, rate_hz, seconds):
+        unknown = [name for name in param_names if name not in device_params]
+        if unknown:
+            raise KeyError(", ".join(unknown))
+        if not 0 < rate_hz <= d["burst_max_rate_hz"]:
+            raise ValueError(f"Частота захвата должна быть от 0 до {d['burst_max_rate_hz']} Гц")
+        if not 0 < seconds <= d["burst_max_seconds"]:
+            raise ValueError(f"Длительность захвата должна быть от 0 до {d['burst_max_seconds']} с")
+        capture = BurstCapture(next(self._ids), [device_params[name] for name in param_names], rate_hz, seconds)
+        self.captures[capture.id] = capture
+        finished = [capture_id for capture_id, item in self.captures.items() if item.state in ("done", "stopped")]
+        for capture_id in finished[:max(len(finished) - self.keep, 0)]:
+            del self.captures[capture_id]
+        return capture
+
+    # Захват по событию (например, сброс давления в лаб. 13) из цикла событий modbus_service
+    def trigger(self, config):
+        if not config:
+            return None
+        capture = self.create(config["params"], config["rate_hz"], config["seconds"])
+        capture.task = asyncio.ensure_future(capture.run())
+        return capture
+
+    def get(self, capture_id):
+        capture = self.captures.get(capture_id)
+        if capture is None:
+            abort(404, message=f"Нет захвата {capture_id}")
+        return capture
+
+
+burst_manager = BurstManager(d["burst_keep"])
+
+
+# Запуск захвата: POST /burst?params=P&rate_hz=50&seconds=5
+class BurstListAPI(Resource):
+    def get(self):
+        return {"captures": [capture.status() for capture in burst_manager.captures.values()]}
+
+    def post(self):
+        parser = reqparse.RequestParser(bundle_errors=True)
+        parser.add_argument("params", type=str, location="args", required=True)
+        parser.add_argument("rate_hz", type=float, location="args", default=20)
+        parser.add_argument("seconds", type=float, location="args", default=5)
+        query = parser.parse_args()
+        try:
+            capture = burst_manager.create(query["params"].split(","), query["rate_hz"], query["seconds"])
+        except KeyError as e:
+            abort(404, message=f"Нет параметров {e.args[0]}")
+        except ValueError as e:
+            abort(400, message=str(e))
+        modbus_service.submit(capture.run())
+        return capture.status(), 201
+
+
+# Состояние захвата и его досрочная остановка: GET/DELETE /burst/<id>
+class BurstAPI(Resource):
+    def get(self, capture_id):
+        return burst_manager.get(capture_id).status()
+
+    def delete(self, capture_id):
+        capture = burst_manager.get(capture_id)
+        if capture.task is not None:
+            # Задача живет в цикле событий modbus_service, отменяем ее из этого цикла
+            modbus_service.loop.call_soon_threadsafe(capture.task.cancel)
+        return capture.status()
+
+
+# Данные захвата одним блоком: GET /burst/<id>/data?format=csv|bin.
+# Формат bin - строки подряд из float64 little-endian: время, значения параметров в порядке X-Burst-Columns
+class BurstDataAPI(Resource):
+    def get(self, capture_id):
+        capture = burst_manager.get(capture_id)
+        parser = reqparse.RequestParser(bundle_errors=True)
+        parser.add_argument("format", type=str, location="args", choices=("csv", "bin"), default="csv")
+        query = parser.parse_args()
+        columns = ",".join(["ts"] + capture.buffer.columns)
+        if query["format"] == "csv":
+            return Response(capture.buffer.to_csv(), mimetype="text/csv",
+                            headers={"Content-Disposition": f"attachment; filename=burst_{capture_id}.csv"})
+        data = capture.buffer.to_array()
+        if sys.byteorder != "little":
+            data.byteswap()
+        return Response(data.tobytes(), mimetype="application/octet-stream",
+                        headers={"Content-Disposition": f"attachment; filename=burst_{capture_id}.bin",
+                                 "X-Burst-Columns": columns})
+
+
+api.add_resource(BurstListAPI, '/burst')
+api.add_resource(BurstAPI, '/burst/<int:capture_id>')
+api.add_resource(BurstDataAPI, '/burst/<int:capture_id>/data')
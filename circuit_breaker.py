@@ -0,0 +1,72 @@
+import json
+import logging
+import time
+from device_profiles import device_labs
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+# Переходы состояний пишутся в журнал опроса
+logger = logging.getLogger("poll_params_logger")
+
+CLOSED = "closed"        # устройство отвечает, опрашивается как обычно
+OPEN = "open"            # устройство недоступно, опрос пропускается до времени проверки
+HALF_OPEN = "half_open"  # идет пробный опрос после паузы
+
+
+# Автомат отключения опроса недоступного устройства. После failure_threshold неудачных опросов подряд
+# устройство пропускается, а пробные опросы выполняются с паузой, удваивающейся до backoff_max секунд
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=3, backoff=2.0, backoff_max=60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.state = CLOSED
+        self.failures = 0   # неудачные опросы подряд
+        self.openings = 0   # открытия подряд без успешного опроса, задают длину паузы
+        self.retry_at = 0.0
+        self.skipped = 0
+
+    # Можно ли опрашивать устройство сейчас; в полуоткрытом состоянии допускается один пробный опрос
+    def allow(self, now=None):
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and (now or time.monotonic()) >= self.retry_at:
+            self.state = HALF_OPEN
+            return True
+        self.skipped += 1
+        return False
+
+    def record(self, success, now=None):
+        if success:
+            if self.state != CLOSED:
+                logger.info("Устройство %s снова доступно, опрос возобновлен", self.name)
+            self.state = CLOSED
+            self.failures = 0
+            self.openings = 0
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            delay = min(self.backoff * 2 ** self.openings, self.backoff_max)
+            if self.state == CLOSED:
+                logger.warning("Устройство %s не отвечает, опрос приостановлен", self.name)
+            self.openings += 1
+            self.state = OPEN
+            self.retry_at = (now or time.monotonic()) + delay
+
+    # Пробный опрос не состоялся (прерван до первого запроса): проверка повторится при следующем опросе
+    def cancel_probe(self):
+        if self.state == HALF_OPEN:
+            self.state = OPEN
+
+    def status(self):
+        return {"state": self.state, "failures": self.failures, "skipped": self.skipped,
+                "retry_in_seconds": round(max(self.retry_at - time.monotonic(), 0), 1) if self.state == OPEN else None}
+
+
+# Автоматы отключения всех устройств из config.json
+device_breakers = {device: CircuitBreaker(device, d["breaker_failure_threshold"], d["breaker_backoff_seconds"],
+                                          d["breaker_backoff_max_seconds"])
+                   for device in device_labs}
@@ -0,0 +1,170 @@
+import json
+import struct
+from collections import namedtuple
+from read_plan import ParamSpec, HOLDING_REGISTERS
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+# Формат struct и число регистров для поддерживаемых типов данных
+DATA_TYPES = {
+    "uint16": ("H", 1),
+    "int16": ("h", 1),
+    "uint32": ("I", 2),
+    "int32": ("i", 2),
+    "float32": ("f", 2),
+    "float64": ("d", 4)
+}
+
+
+# Базовый период опроса: с этим шагом планировщик запускает цикл, интервалы параметров кратны ему
+POLL_TICK = d["poll_time_minutes"] * 60 + d["poll_time_seconds"]
+
+# Настройки опроса параметра: интервал (в адаптивном режиме - наибольший), наименьший интервал адаптивного
+# режима (None - интервал постоянный) и зона нечувствительности для записи и рассылки (None - без фильтра)
+PollOptions = namedtuple("PollOptions", ["interval", "min_interval", "deadband"])
+
+# Шлюз Modbus TCP: адрес, число соединений пула и число одновременных запросов опроса.
+# У шины Modbus RTU вместо адреса задается последовательный порт serial (SerialLine)
+Gateway = namedtuple("Gateway", ["name", "host", "port", "pool_size", "concurrency", "serial"], defaults=(None,))
+
+# Последовательный порт шины RTU: скорость и формат символа, пауза прибора после ответа и время ожидания ответа
+SerialLine = namedtuple("SerialLine", ["port", "baudrate", "bytesize", "parity", "stopbits", "turnaround",
+                                       "response_timeout"])
+
+# Шлюз из server_host/server_port: к нему относятся приборы, для которых шлюз не указан
+DEFAULT_GATEWAY = "default"
+
+
+# Компиляция функции перевода регистров в значение параметра
+def compile_decoder(data_type="uint16", word_order="big", scale=1, offset=0, digits=None):
+    if data_type not in DATA_TYPES:
+        raise ValueError(f"Неизвестный тип данных {data_type}")
+    if word_order not in ("big", "little"):
+        raise ValueError(f"Неизвестный порядок слов {word_order}")
+    fmt, count = DATA_TYPES[data_type]
+    pack_words = struct.Struct(f">{count}H").pack
+    unpack_value = struct.Struct(f">{fmt}").unpack
+    swap_words = word_order == "little" and count > 1
+
+    if count == 1:
+        if data_type == "uint16":
+            def raw(registers):
+                return registers[0]
+        else:
+            def raw(registers):
+                return unpack_value(pack_words(registers[0]))[0]
+    elif swap_words:
+        def raw(registers):
+            return unpack_value(pack_words(*registers[count - 1::-1]))[0]
+    else:
+        def raw(registers):
+            return unpack_value(pack_words(*registers[:count]))[0]
+
+    if scale == 1 and offset == 0:
+        scaled = raw
+    else:
+        def scaled(registers):
+            return raw(registers) * scale + offset
+
+    if digits is None:
+        return scaled
+
+    def decode(registers):
+        return round(scaled(registers), digits)
+    return decode
+
+
+# Сборка описаний параметров из профилей устройств в config.json
+def compile_params(config):
+    profiles = config.get("profiles", {})
+    params = {}
+    endpoints = {}
+    device_labs = {}
+    poll_options = {}
+    for lab_num in config["labs"]:
+        for device, device_config in config[lab_num].items():
+            if device in device_labs:
+                raise ValueError(f"Прибор {device} описан несколько раз")
+            device_labs[device] = lab_num
+            profile = profiles.get(device_config.get("profile"), {})
+            for param_name, param_config in device_config.get("params", {}).items():
+                if param_name in params:
+                    raise ValueError(f"Параметр {param_name} описан несколько раз")
+                options = dict(profile, **param_config)
+                data_type = options.get("data_type", "uint16")
+                decode = compile_decoder(data_type, options.get("word_order", "big"), options.get("scale", 1),
+                                         options.get("offset", 0), options.get("round"))
+                params[param_name] = ParamSpec(param_name, device, device_config["slave_id"],
+                                               options.get("function_code", HOLDING_REGISTERS), options["register"],
+                                               DATA_TYPES[data_type][1], decode)
+                if "endpoint" in options:
+                    endpoints[(lab_num, device, options["endpoint"])] = param_name
+                poll_options[param_name] = PollOptions(max(options.get("interval", POLL_TICK), POLL_TICK),
+                                                       options.get("min_interval"), options.get("deadband"))
+    return params, endpoints, device_labs, poll_options
+
+
+# Шлюзы из config.json и шлюз каждого прибора. Шлюз с "transport": "rtu" - последовательная шина Modbus RTU.
+# Шлюз прибора задается ключом "gateway" в описании прибора,
+# иначе шлюзом лабораторной работы из lab_gateways, иначе это шлюз server_host/server_port
+def compile_gateways(config, device_labs):
+    gateways = {}
+    if "server_host" in config:
+        gateways[DEFAULT_GATEWAY] = Gateway(DEFAULT_GATEWAY, config["server_host"], config["server_port"],
+                                            config["pool_size"], config["poll_concurrency"])
+    for name, gateway_config in config.get("gateways", {}).items():
+        transport = gateway_config.get("transport", "tcp")
+        concurrency = gateway_config.get("poll_concurrency", config["poll_concurrency"])
+        if transport == "rtu":
+            line = SerialLine(gateway_config["serial_port"], gateway_config.get("baudrate", 9600),
+                              gateway_config.get("bytesize", 8), gateway_config.get("parity", "N"),
+                              gateway_config.get("stopbits", 1), gateway_config.get("turnaround", 0.0),
+                              gateway_config.get("response_timeout", config["read_timeout"]))
+            gateways[name] = Gateway(name, None, None, 1, concurrency, line)
+        elif transport == "tcp":
+            gateways[name] = Gateway(name, gateway_config["host"], gateway_config.get("port", 502),
+                                     gateway_config.get("pool_size", config["pool_size"]), concurrency)
+        else:
+            raise ValueError(f"Неизвестный транспорт {transport} у шлюза {name}")
+    lab_gateways = config.get("lab_gateways", {})
+    device_gateways = {}
+    for device, lab_num in device_labs.items():
+        name = config[lab_num][device].get("gateway", lab_gateways.get(lab_num, DEFAULT_GATEWAY))
+        if name not in gateways:
+            raise ValueError(f"Неизвестный шлюз {name} у прибора {device}")
+        device_gateways[device] = gateways[name]
+    return gateways, device_gateways
+
+
+# Параметры по имени, ручки REST (лаба, прибор, функция) -> параметр, лаба каждого прибора и настройки опроса
+device_params, endpoint_params, device_labs, poll_options = compile_params(d)
+
+# Шлюзы по имени и шлюз каждого прибора
+gateways, device_gateways = compile_gateways(d, device_labs)
+
+
+# Приборы лабораторной работы
+def lab_devices(lab_num):
+    return [device for device, lab in device_labs.items() if lab == lab_num]
+
+
+# Наибольший возраст значения из кэша для запроса чтения: max_age запроса, а без него cache_max_age,
+# но не меньше интервала опроса параметра с запасом на шаг планировщика, иначе параметры
+# с редким опросом почти всегда читались бы с прибора
+def param_max_age(param_name, max_age=None):
+    if max_age is not None:
+        return max_age
+    return max(d["cache_max_age"], poll_options[param_name].interval + POLL_TICK)
+
+
+# Номер установки в units.db и static_params (equipment_id): lab13 -> 13
+def lab_unit_id(lab_num):
+    return int(lab_num[len("lab"):])
+
+
+# Параметр, который читает ручка REST, или None
+def endpoint_param(lab_num, device, function):
+    name = endpoint_params.get((lab_num, device, function))
+    return device_params[name] if name else None
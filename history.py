@@ -0,0 +1,248 @@
+import glob
+import json
+import os
+import sqlite3
+import time
+from datetime import date, timedelta
+from metrics import sqlite_write_seconds
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+# История хранится посуточными файлами, поэтому очистка старых данных - это удаление файла
+PARTITION_FORMAT = "%Y%m%d"
+PARTITION_PREFIX = "samples_"
+
+# Метрика времени записи истории: получается один раз, запись каждого цикла ее не ищет
+history_write_seconds = sqlite_write_seconds.labels("history")
+
+# Первичный ключ (param, ts) служит индексом для выборок по параметру и времени
+CREATE_SAMPLES_TABLE = """
+    CREATE TABLE IF NOT EXISTS samples (
+        param TEXT NOT NULL,
+        ts REAL NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (param, ts)
+    ) WITHOUT ROWID
+"""
+
+
+# Агрегаты по интервалам фиксированной длины для одного уровня свертки
+CREATE_ROLLUP_TABLE = """
+    CREATE TABLE IF NOT EXISTS rollup_{seconds} (
+        param TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        v_min REAL NOT NULL,
+        v_max REAL NOT NULL,
+        v_sum REAL NOT NULL,
+        n INTEGER NOT NULL,
+        v_last REAL NOT NULL,
+        ts_last REAL NOT NULL,
+        PRIMARY KEY (param, bucket)
+    ) WITHOUT ROWID
+"""
+
+# Добавление новых значений к уже накопленным агрегатам интервала
+UPSERT_ROLLUP = """
+    INSERT INTO rollup_{seconds} (param, bucket, v_min, v_max, v_sum, n, v_last, ts_last)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (param, bucket) DO UPDATE SET
+        v_min = min(v_min, excluded.v_min),
+        v_max = max(v_max, excluded.v_max),
+        v_sum = v_sum + excluded.v_sum,
+        n = n + excluded.n,
+        v_last = CASE WHEN excluded.ts_last >= ts_last THEN excluded.v_last ELSE v_last END,
+        ts_last = max(ts_last, excluded.ts_last)
+"""
+
+# Выражения SQL для перевода агрегатов уровня свертки в агрегаты запрошенного шага
+ROLLUP_AGGREGATES = {
+    "min": "MIN(v_min)",
+    "max": "MAX(v_max)",
+    "avg": "SUM(v_sum) / SUM(n)",
+    "last": "v_last"
+}
+
+
+# Свертки истории (например, по 10 с, 1 мин и 1 ч), которые обновляются при записи каждого цикла
+class Rollups:
+    def __init__(self, path, tiers):
+        self.path = path
+        self.tiers = {int(seconds): days for seconds, days in tiers.items()}  # длина интервала -> срок хранения в сутках
+        self._conn = None
+
+    def _writer(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for seconds in self.tiers:
+                conn.execute(CREATE_ROLLUP_TABLE.format(seconds=seconds))
+                conn.execute(f"CREATE INDEX IF NOT EXISTS rollup_{seconds}_bucket ON rollup_{seconds} (bucket)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def update(self, samples):
+        conn = self._writer()
+        with conn:
+            for seconds in self.tiers:
+                buckets = {}
+                for param_name, value, timestamp in samples:
+                    key = (param_name, int(timestamp // seconds) * seconds)
+                    item = buckets.get(key)
+                    if item is None:
+                        buckets[key] = [value, value, value, 1, value, timestamp]
+                    else:
+                        item[0] = min(item[0], value)
+                        item[1] = max(item[1], value)
+                        item[2] += value
+                        item[3] += 1
+                        if timestamp >= item[5]:
+                            item[4], item[5] = value, timestamp
+                conn.executemany(UPSERT_ROLLUP.format(seconds=seconds),
+                                 [(param_name, bucket, *item) for (param_name, bucket), item in buckets.items()])
+
+    # Самый крупный уровень свертки, из которого можно собрать запрошенный шаг, или None
+    def tier_for(self, step):
+        suitable = [seconds for seconds in self.tiers if seconds <= step and step % seconds == 0]
+        return max(suitable) if suitable else None
+
+    # Агрегаты параметра с шагом step за интервал [start, end): [(начало интервала, значение)]
+    def query(self, param_name, start, end, step, agg):
+        seconds = self.tier_for(step)
+        if not os.path.exists(self.path):
+            return []
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute(f"""
+                SELECT (bucket / ?) * ? AS step_bucket, {ROLLUP_AGGREGATES[agg]}, MAX(ts_last)
+                FROM rollup_{seconds}
+                WHERE param = ? AND bucket >= ? AND bucket < ?
+                GROUP BY step_bucket ORDER BY step_bucket
+            """, (step, step, param_name, int(start // seconds) * seconds, end)).fetchall()
+        finally:
+            conn.close()
+        return [(bucket, value) for bucket, value, _ in rows]
+
+    def drop_expired(self, now=None):
+        conn = self._writer()
+        now = now or time.time()
+        with conn:
+            for seconds, days in self.tiers.items():
+                conn.execute(f"DELETE FROM rollup_{seconds} WHERE bucket < ?", (now - days * 86400,))
+
+
+# Агрегация сырых значений с произвольным шагом: [(начало интервала, значение)]
+def aggregate_samples(samples, step, agg):
+    buckets = {}
+    for timestamp, value in samples:
+        buckets.setdefault(int(timestamp // step) * step, []).append(value)
+    result = []
+    for bucket, values in sorted(buckets.items()):
+        if agg == "min":
+            result.append((bucket, min(values)))
+        elif agg == "max":
+            result.append((bucket, max(values)))
+        elif agg == "avg":
+            result.append((bucket, sum(values) / len(values)))
+        else:
+            result.append((bucket, values[-1]))
+    return result
+
+
+# Хранилище истории значений параметров с разбиением по суткам
+class HistoryStore:
+    def __init__(self, directory, retention_days, rollup_tiers=None):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.rollups = Rollups(os.path.join(directory, "rollups.db"), rollup_tiers or {})
+        self._day = None
+        self._conn = None  # соединение для записи, используется только циклом опроса
+        os.makedirs(directory, exist_ok=True)
+
+    def partition_path(self, day):
+        return os.path.join(self.directory, f"{PARTITION_PREFIX}{day}.db")
+
+    @staticmethod
+    def day_of(timestamp):
+        return time.strftime(PARTITION_FORMAT, time.localtime(timestamp))
+
+    def _writer(self, day):
+        if day != self._day:
+            if self._conn:
+                self._conn.close()
+            conn = sqlite3.connect(self.partition_path(day))
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(CREATE_SAMPLES_TABLE)
+            self._conn, self._day = conn, day
+        return self._conn
+
+    # Запись значений цикла опроса: одна транзакция на каждую затронутую секцию
+    def append(self, samples):
+        started = time.perf_counter()
+        by_day = {}
+        for param_name, value, timestamp in samples:
+            by_day.setdefault(self.day_of(timestamp), []).append((param_name, timestamp, value))
+        for day, rows in sorted(by_day.items()):
+            conn = self._writer(day)
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO samples (param, ts, value) VALUES (?, ?, ?)", rows)
+        if self.rollups.tiers:
+            self.rollups.update(samples)
+        history_write_seconds.observe(time.perf_counter() - started)
+
+    # Секции, пересекающиеся с интервалом [start, end)
+    def _partitions(self, start, end):
+        day = date.fromtimestamp(start)
+        last = date.fromtimestamp(end)
+        while day <= last:
+            path = self.partition_path(day.strftime(PARTITION_FORMAT))
+            if os.path.exists(path):
+                yield path
+            day += timedelta(days=1)
+
+    # Значения параметра за интервал [start, end) в порядке времени: [(ts, value)]
+    def query(self, param_name, start, end):
+        result = []
+        for path in self._partitions(start, end):
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                result.extend(conn.execute("SELECT ts, value FROM samples WHERE param = ? AND ts >= ? AND ts < ? "
+                                           "ORDER BY ts", (param_name, start, end)))
+            finally:
+                conn.close()
+        return result
+
+    # Значения параметра с шагом step и агрегатом agg: из свертки, если она подходит, иначе из сырых данных
+    def query_aggregated(self, param_name, start, end, step, agg):
+        tier = self.rollups.tier_for(step)
+        if tier is not None:
+            return f"rollup_{tier}", self.rollups.query(param_name, start, end, step, agg)
+        return "raw", aggregate_samples(self.query(param_name, start, end), step, agg)
+
+    # Удаление секций старше срока хранения
+    def drop_expired(self, now=None):
+        cutoff = (date.fromtimestamp(now or time.time()) - timedelta(days=self.retention_days))
+        cutoff = cutoff.strftime(PARTITION_FORMAT)
+        dropped = []
+        for path in glob.glob(os.path.join(self.directory, f"{PARTITION_PREFIX}*.db")):
+            day = os.path.basename(path)[len(PARTITION_PREFIX):-len(".db")]
+            if day < cutoff and day != self._day:
+                for file_path in (path, path + "-wal", path + "-shm"):
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+                dropped.append(day)
+        if self.rollups.tiers:
+            self.rollups.drop_expired(now)
+        return dropped
+
+
+history_store = HistoryStore(d["history_dir"], d["history_retention_days"], d["history_rollup_tiers"])
+
+
+# Очистка устаревшей истории для планировщика
+async def drop_expired_history():
+    history_store.drop_expired()
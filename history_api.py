@@ -0,0 +1,63 @@
+import json
+import time
+from datetime import datetime
+from flask import Blueprint, request
+from flask_restful import Api, Resource, abort
+from device_profiles import device_params
+from history import history_store, ROLLUP_AGGREGATES
+
+history_api = Blueprint('history_api', __name__)
+api = Api(history_api)
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+
+# Время из запроса: секунды Unix или дата в формате ISO
+def _parse_time(name, default):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        abort(400, message=f"Неверное время {name}: {value}")
+
+
+# История параметра: GET /history/<param>?from=&to=&step=&agg=min|max|avg|last
+class HistoryAPI(Resource):
+    def get(self, param):
+        if param not in device_params:
+            abort(404, message=f"Нет параметра {param}")
+        end = _parse_time("to", time.time())
+        start = _parse_time("from", end - 3600)
+        agg = request.args.get("agg", "avg")
+        if agg not in ROLLUP_AGGREGATES:
+            abort(400, message=f"Неверный агрегат {agg}")
+        try:
+            step = int(request.args.get("step", 60))
+        except ValueError:
+            abort(400, message="Шаг step задается целым числом секунд")
+        if step <= 0 or start >= end:
+            abort(400, message="Неверный интервал или шаг")
+        if (end - start) / step > d["history_max_points"]:
+            abort(400, message=f"Слишком много точек, максимум {d['history_max_points']}")
+
+        source, points = history_store.query_aggregated(param, start, end, step, agg)
+        return {
+            "param": param,
+            "from": start,
+            "to": end,
+            "step": step,
+            "agg": agg,
+            "source": source,
+            "points": [[bucket, value] for bucket, value in points]
+        }
+
+
+api.add_resource(HistoryAPI, '/history/<string:param>')
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from device_profiles import device_labs
+from modbus_pool import PRIORITY_URGENT
+from write_queue import write_queue, execute_steps
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+# Сообщения блокировок пишутся в журнал опроса
+logger = logging.getLogger("poll_params_logger")
+
+
+# Адрес регистра действия: число или имя регистра из описания прибора ("pump_register")
+def _register(device, register):
+    if isinstance(register, str):
+        return d[device_labs[device]][device][register]
+    return register
+
+
+# Действия блокировки из config.json: [("write", прибор, slave_id, регистр, значение) | ("delay", секунды)]
+def compile_actions(actions):
+    compiled = []
+    for action in actions:
+        if "delay" in action:
+            compiled.append(("delay", action["delay"]))
+            continue
+        device = action["device"]
+        if device not in device_labs:
+            raise ValueError(f"Неизвестный прибор {device} в действии блокировки")
+        slave_id = d[device_labs[device]][device]["slave_id"]
+        compiled.append(("write", device, slave_id, _register(device, action["register"]), action["value"]))
+    return compiled
+
+
+# Действия блокировки по приборам: [(прибор, шаги execute_steps)]. Пауза относится к шагам прибора перед ней
+# (паузы в начале - к прибору None), поэтому последовательность на приборе выполняется целиком под его
+# блокировкой и обычные команды записи не вклиниваются между ее шагами
+def device_steps(actions):
+    groups = []
+    for action in actions:
+        if action[0] == "delay":
+            if groups:
+                groups[-1][1].append(action)
+            else:
+                groups.append((None, [action]))
+            continue
+        _, device, slave_id, register, value = action
+        if not groups or groups[-1][0] != device:
+            groups.append((device, []))
+        groups[-1][1].append(("write", slave_id, register, value))
+    return groups
+
+
+# Правило блокировки: срабатывает, когда значение параметра выходит за порог, и снова
+# взводится только после возврата за порог сброса (гистерезис)
+class InterlockRule:
+    def __init__(self, name, param, actions, above=None, below=None, reset=None, priority=PRIORITY_URGENT):
+        if (above is None) == (below is None):
+            raise ValueError(f"Для блокировки {name} нужен ровно один порог: above или below")
+        self.name = name
+        self.param = param
+        self.actions = actions
+        self.steps = device_steps(actions)
+        self.above = above
+        self.below = below
+        self.reset = reset if reset is not None else (above if above is not None else below)
+        self.priority = priority
+        self.tripped = False
+        self.trips = 0
+
+    @classmethod
+    def from_config(cls, config):
+        reset = config.get("reset_below", config.get("reset_above"))
+        return cls(config["name"], config["param"], compile_actions(config["actions"]), config.get("above"),
+                   config.get("below"), reset, config.get("priority", PRIORITY_URGENT))
+
+    # Проверка нового значения: True, если блокировка сработала именно на нем
+    def check(self, value):
+        if self.tripped:
+            if (value < self.reset) if self.above is not None else (value > self.reset):
+                self.tripped = False
+            return False
+        if (value > self.above) if self.above is not None else (value < self.below):
+            self.tripped = True
+            self.trips += 1
+            return True
+        return False
+
+
+# Движок блокировок: проверяет каждое полученное значение сразу после декодирования
+# и ставит действия сработавших правил в срочную очередь записи
+class InterlockEngine:
+    def __init__(self, rules, history_size=50):
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.param, []).append(rule)
+        self.history = deque(maxlen=history_size)  # последние срабатывания с временами выполнения
+
+    def on_sample(self, param_name, value, timestamp):
+        for rule in self.rules.get(param_name, ()):
+            if rule.check(value):
+                self._trip(rule, value, timestamp)
+
+    def _trip(self, rule, value, timestamp):
+        logger.warning("Сработала блокировка %s: %s = %s", rule.name, rule.param, value)
+        trip = {"rule": rule.name, "param": rule.param, "value": value, "sample_ts": timestamp,
+                "queued_seconds": round(time.time() - timestamp, 4), "started_seconds": None,
+                "first_write_seconds": None, "done_seconds": None, "error": None}
+        self.history.append(trip)
+
+        def written():
+            if trip["first_write_seconds"] is None:
+                trip["first_write_seconds"] = round(time.time() - timestamp, 4)
+
+        async def run_actions():
+            trip["started_seconds"] = round(time.time() - timestamp, 4)
+            for device, steps in rule.steps:
+                if device is None:
+                    await asyncio.sleep(sum(step[1] for step in steps))
+                    continue
+                # Шаги прибора - одна команда, как у команд записи; соединение для каждой записи
+                # берется отдельно, чтобы не держать его во время пауз
+                await execute_steps(device, steps, rule.priority, written)
+            trip["done_seconds"] = round(time.time() - timestamp, 4)
+
+        future = write_queue.submit(run_actions, rule.priority)
+        future.add_done_callback(lambda f: self._finished(rule, trip, f))
+
+    # Если действия не выполнены, правило снова взводится: следующее значение за порогом
+    # повторит их, как и без блокировки по гистерезису
+    def _finished(self, rule, trip, future):
+        if future.cancelled():
+            trip["error"] = "Отменено"
+            rule.tripped = False
+        elif future.exception() is not None:
+            trip["error"] = str(future.exception())
+            rule.tripped = False
+            logger.error("Ошибка выполнения блокировки %s: %s", rule.name, trip["error"])
+        else:
+            logger.warning("Блокировка %s выполнена за %s с от получения значения", rule.name, trip["done_seconds"])
+
+    def status(self):
+        return {
+            "rules": [{"name": rule.name, "param": rule.param, "above": rule.above, "below": rule.below,
+                       "reset": rule.reset, "tripped": rule.tripped, "trips": rule.trips}
+                      for rules in self.rules.values() for rule in rules],
+            "trips": list(self.history),
+            "queue": {"pending": write_queue.pending, **write_queue.stats}
+        }
+
+
+interlock_engine = InterlockEngine([InterlockRule.from_config(rule) for rule in d.get("interlocks", [])])
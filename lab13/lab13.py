@@ -1,13 +1,20 @@
 import json
-import logging
 import os
 from locks import device_locks
+import time
 from time import sleep
-from logging.handlers import RotatingFileHandler
 import asyncio
 from flask import Blueprint
 from flask_restful import Api, Resource, marshal, fields, abort, reqparse
-from pymodbus.client import AsyncModbusTcpClient
+from modbus_pool import device_pool
+from modbus_service import modbus_service
+from device_profiles import lab_devices, endpoint_param, param_max_age
+from read_plan import execute_request, single_request
+from value_cache import value_cache, format_timestamp
+from log_queue import create_logger
+from interlocks import interlock_engine
+from burst import burst_manager
+from write_queue import write_queue, WriteError
 from pymodbus.exceptions import ConnectionException, ModbusIOException, ParameterException, NoSuchSlaveException, \
     NotImplementedException, InvalidMessageReceivedException, MessageRegisterException
 
@@ -21,86 +28,79 @@ with open('config.json') as f:
     d = json.load(f)
 
 
-# Создание логгера
-def create_logger(logger_name, log_file):
-    logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.INFO)
-    handler = RotatingFileHandler(log_file, maxBytes=3000000, backupCount=3)
-    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-    logger.addHandler(handler)
-    return logger
-
-
 lab13_logger = create_logger("lab13_logger", "lab13.log")
 
 
 def log_error(code, message):
-    lab13_logger.error(f'Ошибка {code}: {message}')
+    lab13_logger.error('Ошибка %s: %s', code, message)
     abort(code, message=message)
 
 
 class Lab13API(Resource):
     def get(self, device, function):
-        if device == "trm202" or device == "pressure_sensor":  # устройство лабы "Опытное определение показателя адиабаты воздуха"
+        if device in lab_devices(lab_num):  # устройства лабы "Опытное определение показателя адиабаты воздуха"
+            # Неверный max_age - ошибка запроса (400), поэтому параметры разбираются до перехвата ошибок
+            parser = reqparse.RequestParser(bundle_errors=True)
+            parser.add_argument("max_age", type=float, location="args")
+            query = parser.parse_args()
             try:
-                data = asyncio.run(self._read_device_data(device, function))
+                # Свежее значение из кэша опроса отдаем без обращения к прибору
+                spec = endpoint_param(lab_num, device, function)
+                sample = value_cache.get(spec.name, param_max_age(spec.name, query["max_age"])) if spec else None
+                if sample:
+                    return self._result(device, function, sample.value, sample.timestamp, True)
+                data = modbus_service.run(self._read_device_data(device, function))
                 return data
             except Exception as e:
                 log_error(500, f"Unexpected error: {str(e)}")
         else:
             log_error(404, "Нет устройства {} в {}".format(device, lab_num))
 
+    # Ответ с прочитанным значением, временем его получения и признаком чтения из кэша
+    def _result(self, device, function, value, timestamp, cached):
+        result = [{'Прибор': device, 'Функция': function, 'Значение': value,
+                   'Время': format_timestamp(timestamp), 'Из кэша': cached}]
+        reg_fields = {'Прибор': fields.String, 'Функция': fields.String, 'Значение': fields.Float,
+                      'Время': fields.String, 'Из кэша': fields.Boolean}
+        return {'Полученные значения': [marshal(reg, reg_fields) for reg in result]}
+
     async def _read_device_data(self, device, function):
         slave_id = d[lab_num][device]["slave_id"]
-        host = d["server_host"]
-        port = d["server_port"]
-        connection_timeout = d["connection_timeout"]
-        start_address = None
-        count = None
-        if device == "pressure_sensor":   
-            count = 2
-            start_address = d["lab13"]["pressure_sensor"]["first_register"]
-        else:
-            if function == "get_temp":  # по ручке получаем регистр
-                count = 1
-                start_address = d["lab13"]["trm202"]["first_register"]
-            else:
-                log_error(404, f"Нет функции {function}")
+        spec = endpoint_param(lab_num, device, function)  # по ручке получаем параметр из профиля устройства
+        if spec is None:
+            log_error(404, f"Нет функции {function}")
 
         async with device_locks[device]:
             try:
-                client = AsyncModbusTcpClient(host, port=port)
-                await asyncio.wait_for(client.connect(), timeout=connection_timeout)
-                try:
-                    data = await client.read_holding_registers(address=start_address, count=count, slave=slave_id)
-                    if not data.isError():
-                        print(data.registers)
-                        if device == "pressure_sensor":
-                            value_float32 = client.convert_from_registers(data.registers, data_type=client.DATATYPE.FLOAT32)
+                async with device_pool(device).connection() as client:
+                    try:
+                        data = await execute_request(client, single_request(spec))
+                        if not data.isError():
+                            value_float32 = spec.decode(data.registers)
+                            lab13_logger.info("Лаб13, прибор %s, функция %s, прочитано значение %s",
+                                              device, function, value_float32)
+                            timestamp = time.time()
+                            interlock_engine.on_sample(spec.name, value_float32, timestamp)
+                            value_cache.update(spec.name, value_float32, timestamp)
+                            return self._result(device, function, value_float32, timestamp, False)
                         else:
-                            value_float32 = data.registers[0] / 10
-                        lab13_logger.info(
-                            f"Лаб13, прибор {device}, функция {function}, прочитано значение {value_float32}")
-                        result = [{'Прибор': device, 'Функция': function, 'Значение': value_float32}]
-                        reg_fields = {'Прибор': fields.String, 'Функция': fields.String, 'Значение': fields.Float}
-                        return {'Полученные значения': [marshal(reg, reg_fields) for reg in result]}
-                    else:
-                        log_error(502, "Ошибка: {}".format(data))
-                except ConnectionException:
-                    log_error(502, "Нет соединения с устройством")
-                except ModbusIOException:
-                    log_error(502, "Нет ответа от устройства")
-                except ParameterException:
-                    log_error(502, "Неверные параметры соединения")
-                except NoSuchSlaveException:
-                    log_error(502, "Нет устройства с id {}".format(slave_id))
-                except NotImplementedException:
-                    log_error(502, "Нет данной функции")
-                except InvalidMessageReceivedException:
-                    log_error(502, "Неверная контрольная сумма в ответе")
-                except MessageRegisterException:
-                    log_error(502, "Неверный адрес регистра")
-                client.close()
+                            log_error(502, "Ошибка: {}".format(data))
+                    except ConnectionException:
+                        log_error(502, "Нет соединения с устройством")
+                    except ModbusIOException:
+                        log_error(502, "Нет ответа от устройства")
+                    except asyncio.TimeoutError:
+                        log_error(504, "Таймаут ответа устройства")
+                    except ParameterException:
+                        log_error(502, "Неверные параметры соединения")
+                    except NoSuchSlaveException:
+                        log_error(502, "Нет устройства с id {}".format(slave_id))
+                    except NotImplementedException:
+                        log_error(502, "Нет данной функции")
+                    except InvalidMessageReceivedException:
+                        log_error(502, "Неверная контрольная сумма в ответе")
+                    except MessageRegisterException:
+                        log_error(502, "Неверный адрес регистра")
             except Exception as e:
                 log_error(502, f"Ошибка Modbus: {str(e)}")
         log_error(500, "Не удалось получить данные")
@@ -108,23 +108,20 @@ class Lab13API(Resource):
     def post(self, device, function):
         if device == "trm202":  # запись только для устройства trm202
             try:
-                data = asyncio.run(self._write_device_data(device, function))
+                # Параметры запроса разбираем в потоке Flask, где доступен контекст запроса
+                parser = reqparse.RequestParser(bundle_errors=True)
+                parser.add_argument("value", type=str, location="args")  # получение значения для записи
+                query = parser.parse_args()
+                data = modbus_service.run(self._write_device_data(device, function, query["value"]))
                 return data
             except Exception as e:
                 log_error(500, f"Unexpected error: {str(e)}")
         else:
             log_error(404, "Нет устройства {} в {}".format(device, lab_num))
 
-    async def _write_device_data(self, device, function):
-        parser = reqparse.RequestParser(bundle_errors=True)
-        parser.add_argument("value", type=str, location="args")  # получение значения для записи
-        query = parser.parse_args()
+    async def _write_device_data(self, device, function, value):
         if device == "trm202":
             slave_id = d[lab_num][device]["slave_id"]
-            value = query["value"]
-            host = d["server_host"]
-            port = d["server_port"]
-            connection_timeout = d["connection_timeout"]
             start_address = None
             if device == "trm202" and function == "set_valve":  # проверяем наличие функции
                 if value == "on" or value == "off":
@@ -135,59 +132,52 @@ class Lab13API(Resource):
                     log_error(404, message="Неверное значение")
             else:
                 log_error(404, message="Нет функции {}".format(function))
-            async with device_locks[device]:
-                client = AsyncModbusTcpClient(host, port=port)
-                await asyncio.wait_for(client.connect(), timeout=connection_timeout)
+            # Шаги каждой функции выполняются одной командой очереди записи, без вклинивания других записей и опроса
+            release = value == "release"
+            capture = None
+            if not release:  # функция on и off
+                value = 1000 if value == "on" else 0
+                steps = [("write", slave_id, 7, 1),  # внешнее управление насоса
+                         ("write", slave_id, start_address, value)]
+            else:  # функция release
+                # Быстрый спад давления после сброса записываем захватом с высокой частотой. Захват начинается
+                # до записи, чтобы застать начало спада, и останавливается, если сброс не выполнен
+                capture = burst_manager.trigger(d.get("burst_on_release"))
+                value = 1000
+                steps = [("write", slave_id, 8, 1),  # внешнее управление клапана
+                         ("write", slave_id, start_address, 0),
+                         ("delay", 1),
+                         ("write", slave_id, start_address, value)]
+            try:
                 try:
-                    if value == "on" or value == "off":  # функция on и off
-                        value = 1000 if value == "on" else 0
-                        data = await client.write_registers(address=7, values=[1],
-                                                            slave=slave_id)  # запись данных
-                        if not data.isError():
-                            lab13_logger.info(f"Лаб13, внешнее управление насоса включено")
-                        data = await client.write_registers(address=start_address, values=[value],
-                                                            slave=slave_id)  # запись данных
-                        if not data.isError():
-                            lab13_logger.info(f"Лаб13, прибор {device}, функция {function}, значение {value} записано")
-                            return {'Функция сработала': True}
-                        else:
-                            log_error(502, "Ошибка: {}".format(data))
-                    else:  # функция release
-                        value = 0
-                        data = await client.write_registers(address=8, values=[1],
-                                                            slave=slave_id)  # запись данных
-                        if not data.isError():
-                            lab13_logger.info(f"Лаб13, внешнее управление клапана включено")
-                        data = await client.write_registers(address=start_address, values=[value],
-                                                            slave=slave_id)  # запись данных
-                        if not data.isError():
-                            lab13_logger.info(f"Лаб13, прибор {device}, функция {function}, значение {value} записано")
-                        else:
-                            log_error(502, "Ошибка: {}".format(data))
-                        await asyncio.sleep(1)
-                        value = 1000
-                        data = await client.write_registers(address=start_address, values=[value],
-                                                            slave=slave_id)  # запись данных
-                        if not data.isError():
-                            lab13_logger.info(f"Лаб13, прибор {device}, функция {function}, значение {value} записано")
-                            return {'Функция release сработала': True}
-                        else:
-                            log_error(502, "Ошибка: {}".format(data))
-                except ConnectionException:
-                    log_error(502, "Нет соединения с устройством")
-                except ModbusIOException:
-                    log_error(502, "Нет ответа от устройства")
-                except ParameterException:
-                    log_error(502, "Неверные параметры соединения")
-                except NoSuchSlaveException:
-                    log_error(502, "Нет устройства с id {}".format(slave_id))
-                except NotImplementedException:
-                    log_error(502, "Нет данной функции")
-                except InvalidMessageReceivedException:
-                    log_error(502, "Неверная контрольная сумма в ответе")
-                except MessageRegisterException:
-                    log_error(502, "Неверный адрес регистра")
-                client.close()
+                    await write_queue.transaction(device, steps)  # запись данных
+                except Exception:
+                    # Сброс не выполнен, записывать нечего: захват останавливается до ответа с ошибкой
+                    if capture:
+                        capture.stop()
+                    raise
+                lab13_logger.info("Лаб13, прибор %s, функция %s, значение %s записано", device, function, value)
+                if release:
+                    if capture:
+                        return {'Функция release сработала': True, 'Захват': capture.id}
+                    return {'Функция release сработала': True}
+                return {'Функция сработала': True}
+            except WriteError as e:
+                log_error(502, "Ошибка: {}".format(e))
+            except ConnectionException:
+                log_error(502, "Нет соединения с устройством")
+            except ModbusIOException:
+                log_error(502, "Нет ответа от устройства")
+            except ParameterException:
+                log_error(502, "Неверные параметры соединения")
+            except NoSuchSlaveException:
+                log_error(502, "Нет устройства с id {}".format(slave_id))
+            except NotImplementedException:
+                log_error(502, "Нет данной функции")
+            except InvalidMessageReceivedException:
+                log_error(502, "Неверная контрольная сумма в ответе")
+            except MessageRegisterException:
+                log_error(502, "Неверный адрес регистра")
 
 
 api.add_resource(Lab13API, '/lab13/<string:device>/<string:function>')
@@ -1,15 +1,21 @@
 import asyncio
 import json
-import logging
 import os
-from logging.handlers import RotatingFileHandler
+import time
 from flask import Blueprint
 from flask_restful import Api, Resource, reqparse, marshal, fields, abort
-from pymodbus.client import AsyncModbusTcpClient
 from pymodbus.exceptions import ConnectionException, ModbusIOException, ParameterException, NoSuchSlaveException, \
     NotImplementedException, InvalidMessageReceivedException, MessageRegisterException
 
 from locks import device_locks
+from modbus_pool import device_pool
+from write_queue import write_queue, WriteError
+from modbus_service import modbus_service
+from device_profiles import lab_devices, endpoint_param, param_max_age
+from read_plan import execute_request, single_request
+from value_cache import value_cache, format_timestamp
+from log_queue import create_logger
+from interlocks import interlock_engine
 
 lab_num = "lab14"
 
@@ -21,93 +27,78 @@ with open('config.json') as f:
     d = json.load(f)
 
 
-# Создание логгера
-def create_logger(logger_name, log_file):
-    logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.INFO)
-    handler = RotatingFileHandler(log_file, maxBytes=3000000, backupCount=3)
-    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-    logger.addHandler(handler)
-    return logger
-
-
 lab14_logger = create_logger("lab14_logger", "lab14.log")
 
 
 # В случае ошибки записываем в логгер и отправляем код ошибки
 def log_error(code, message):
-    lab14_logger.error(f'Ошибка {code}: {message}')
+    lab14_logger.error('Ошибка %s: %s', code, message)
     abort(code, message=message)
 
 
 class Lab14API(Resource):
     def get(self, device, function):
-        if device in ["trm200", "trm210", "sensor"]:  # устройства лабы "Закон Шарля"
+        if device in lab_devices(lab_num):  # устройства лабы "Закон Шарля"
+            # Неверный max_age - ошибка запроса (400), поэтому параметры разбираются до перехвата ошибок
+            parser = reqparse.RequestParser(bundle_errors=True)
+            parser.add_argument("max_age", type=float, location="args")
+            query = parser.parse_args()
             try:
-                data = asyncio.run(self._read_device_data(device, function))
+                # Свежее значение из кэша опроса отдаем без обращения к прибору
+                spec = endpoint_param(lab_num, device, function)
+                sample = value_cache.get(spec.name, param_max_age(spec.name, query["max_age"])) if spec else None
+                if sample:
+                    return self._result(device, function, sample.value, sample.timestamp, True)
+                data = modbus_service.run(self._read_device_data(device, function))
                 return data
             except Exception as e:
                 log_error(500, f"Unexpected error: {str(e)}")
         else:
             log_error(404, "Нет устройства {} в {}".format(device, lab_num))
 
+    # Ответ с прочитанным значением, временем его получения и признаком чтения из кэша
+    def _result(self, device, function, value, timestamp, cached):
+        result = [{'Прибор': device, 'Функция': function, 'Значение': value,
+                   'Время': format_timestamp(timestamp), 'Из кэша': cached}]
+        reg_fields = {'Прибор': fields.String, 'Функция': fields.String, 'Значение': fields.Float,
+                      'Время': fields.String, 'Из кэша': fields.Boolean}
+        return {'Полученные значения': [marshal(reg, reg_fields) for reg in result]}
+
     async def _read_device_data(self, device, function):
         slave_id = d[lab_num][device]["slave_id"]
-        host = d["server_host"]
-        port = d["server_port"]
-        connection_timeout = d["connection_timeout"]
-        start_address = None
-        count = 1
-        if device == "trm200" and function == "get_temp_1":    # первый регистр, проверяем наличие функций
-            start_address = d["lab14"]["trm200"]["first_register"]
-        elif device == "trm200" and function == "get_temp_2":   # второй регистр, проверяем наличие функций
-            start_address = d["lab14"]["trm200"]["second_register"]
-        elif device == "sensor" and function == "get_deltap":
-            start_address = d["lab14"]["sensor"]["first_register"]
-        elif device == "trm210" and function == "get_pressure":
-            start_address = d["lab14"]["trm210"]["first_register"]
-        else:
+        spec = endpoint_param(lab_num, device, function)  # по ручке получаем параметр из профиля устройства
+        if spec is None:
             log_error(404, message="Нет функции {}".format(function))
         async with device_locks[device]:
             try:
-                client = AsyncModbusTcpClient(host, port=port)
-                await asyncio.wait_for(client.connect(), timeout=connection_timeout)
-                try:
-                    if device == "trm200" or device == "trm210":
-                        data = await client.read_holding_registers(address=start_address, count=count, slave=slave_id)  # считывание данных
+                async with device_pool(device).connection() as client:
+                    try:
+                        data = await execute_request(client, single_request(spec))  # считывание данных
                         if not data.isError():
-                            value_float32 = data.registers[0] / 10   # переводим в читаемый вид
-                            lab14_logger.info(f"Лаб14, прибор {device}, функция {function}, прочитано значение {value_float32}")
-                            result = [{'Прибор': device, 'Функция': function, 'Значение': value_float32}]
-                            reg_fields = {'Прибор': fields.String, 'Функция': fields.String, 'Значение': fields.Float}
-                            return {'Полученные значения': [marshal(reg, reg_fields) for reg in result]}    # отправляем на сервис ответ
+                            value_float32 = spec.decode(data.registers)   # переводим в читаемый вид
+                            lab14_logger.info("Лаб14, прибор %s, функция %s, прочитано значение %s", device, function, value_float32)
+                            timestamp = time.time()
+                            interlock_engine.on_sample(spec.name, value_float32, timestamp)
+                            value_cache.update(spec.name, value_float32, timestamp)
+                            return self._result(device, function, value_float32, timestamp, False)    # отправляем на сервис ответ
                         else:
                             log_error(502, "Ошибка: {}".format(data))
-                    elif device == "sensor":
-                        data = await client.read_input_registers(address=start_address, count=count, slave=slave_id)  # считывание данных
-                        if not data.isError():
-                            value_float32 = data.registers[0]
-                            lab14_logger.info(f"Лаб14, прибор {device}, функция {function}, прочитано значение {value_float32}")
-                            result = [{'Прибор': device, 'Функция': function, 'Значение': value_float32}]
-                            reg_fields = {'Прибор': fields.String, 'Функция': fields.String, 'Значение': fields.Float}
-                            return {'Полученные значения': [marshal(reg, reg_fields) for reg in result]}    # отправляем на сервис ответ
-                        else:
-                            log_error(502, "Ошибка: {}".format(data))
-                except ConnectionException:
-                    log_error(502, "Нет соединения с устройством")
-                except ModbusIOException:
-                    log_error(502, "Нет ответа от устройства")
-                except ParameterException:
-                    log_error(502, "Неверные параметры соединения")
-                except NoSuchSlaveException:
-                    log_error(502, "Нет устройства с id {}".format(slave_id))
-                except NotImplementedException:
-                    log_error(502, "Нет данной функции")
-                except InvalidMessageReceivedException:
-                    log_error(502, "Неверная контрольная сумма в ответе")
-                except MessageRegisterException:
-                    log_error(502, "Неверный адрес регистра")
-                client.close()
+                    except ConnectionException:
+                        log_error(502, "Нет соединения с устройством")
+                    except ModbusIOException:
+                        log_error(502, "Нет ответа от устройства")
+                    except asyncio.TimeoutError:
+                        log_error(504, "Таймаут ответа устройства")
+                    except ParameterException:
+                        log_error(502, "Неверные параметры соединения")
+                    except NoSuchSlaveException:
+                        log_error(502, "Нет устройства с id {}".format(slave_id))
+                    except NotImplementedException:
+                        log_error(502, "Нет данной функции")
+                    except InvalidMessageReceivedException:
+                        log_error(502, "Неверная контрольная сумма в ответе")
+                    except MessageRegisterException:
+                        log_error(502, "Неверный адрес регистра")
             except Exception as e:
                 log_error(502, f"Ошибка Modbus: {str(e)}")
             log_error(500, "Не удалось получить данные")
@@ -115,53 +106,46 @@ class Lab14API(Resource):
     def post(self, device, function):
         if device == "trm210":  # запись только для устройства trm210
             try:
-                data = asyncio.run(self._write_device_data(device, function))
+                # Параметры запроса разбираем в потоке Flask, где доступен контекст запроса
+                parser = reqparse.RequestParser(bundle_errors=True)
+                parser.add_argument("value", type=int, location="args")  # получение значения для записи
+                query = parser.parse_args()
+                data = modbus_service.run(self._write_device_data(device, function, query["value"]))
                 return data
             except Exception as e:
                 log_error(500, f"Unexpected error: {str(e)}")
         else:
             log_error(404, "Нет устройства {} в {}".format(device, lab_num))
 
-    async def _write_device_data(self, device, function):
-        parser = reqparse.RequestParser(bundle_errors=True)
-        parser.add_argument("value", type=int, location="args")    # получение значения для записи
-        query = parser.parse_args()
+    async def _write_device_data(self, device, function, value):
         if device == "trm210":
             slave_id = d[lab_num][device]["slave_id"]
-            value = query["value"]
-            host = d["server_host"]
-            port = d["server_port"]
-            connection_timeout = d["connection_timeout"]
             start_address = None
             if device == "trm210" and function == "set_voltage":    # проверяем наличие функции
                 start_address = d[lab_num][device]["write_register"]
             else:
                 log_error(404, message="Нет функции {}".format(function))
-            async with device_locks[device]:
-                client = AsyncModbusTcpClient(host, port=port)
-                await asyncio.wait_for(client.connect(), timeout=connection_timeout)
-                try:
-                    data = await client.write_registers(address=start_address, values=[value], slave=slave_id)  # запись данных
-                    if not data.isError():
-                        lab14_logger.info(f"Лаб14, прибор {device}, функция {function}, значение {value} записано")
-                        return {'Значение записано': True}
-                    else:
-                        log_error(502, "Ошибка: {}".format(data))
-                except ConnectionException:
-                    log_error(502, "Нет соединения с устройством")
-                except ModbusIOException:
-                    log_error(502, "Нет ответа от устройства")
-                except ParameterException:
-                    log_error(502, "Неверные параметры соединения")
-                except NoSuchSlaveException:
-                    log_error(502, "Нет устройства с id {}".format(slave_id))
-                except NotImplementedException:
-                    log_error(502, "Нет данной функции")
-                except InvalidMessageReceivedException:
-                    log_error(502, "Неверная контрольная сумма в ответе")
-                except MessageRegisterException:
-                    log_error(502, "Неверный адрес регистра")
-                client.close()
+            try:
+                # Частые записи (например, при перемещении ползунка) сворачиваются в очереди до последнего значения
+                ack = await write_queue.write(device, slave_id, start_address, value)  # запись данных
+                lab14_logger.info("Лаб14, прибор %s, функция %s, значение %s записано", device, function, ack['value'])
+                return {'Значение записано': True, 'Записанное значение': ack['value']}
+            except WriteError as e:
+                log_error(502, "Ошибка: {}".format(e))
+            except ConnectionException:
+                log_error(502, "Нет соединения с устройством")
+            except ModbusIOException:
+                log_error(502, "Нет ответа от устройства")
+            except ParameterException:
+                log_error(502, "Неверные параметры соединения")
+            except NoSuchSlaveException:
+                log_error(502, "Нет устройства с id {}".format(slave_id))
+            except NotImplementedException:
+                log_error(502, "Нет данной функции")
+            except InvalidMessageReceivedException:
+                log_error(502, "Неверная контрольная сумма в ответе")
+            except MessageRegisterException:
+                log_error(502, "Неверный адрес регистра")
 
 
 api.add_resource(Lab14API, '/lab14/<string:device>/<string:function>')
@@ -1,9 +1,5 @@
 import asyncio
+from device_profiles import device_labs
 
-device_locks = {
-    "trm202": asyncio.Lock(),
-    "pressure_sensor": asyncio.Lock(),
-    "trm200": asyncio.Lock(),
-    "sensor": asyncio.Lock(),
-    "trm210": asyncio.Lock()
-}
\ No newline at end of file
+# Блокировки используются только внутри цикла событий modbus_service
+device_locks = {device: asyncio.Lock() for device in device_labs}
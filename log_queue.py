@@ -0,0 +1,90 @@
+import atexit
+import json
+import logging
+import queue
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+
+# Запись журнала в формате JSON lines: одна строка - один объект
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Постановка записи в очередь без форматирования: сообщение собирается из шаблона % и аргументов
+# уже в фоновом потоке. Аргументы журнала должны быть неизменяемыми значениями (числа, строки)
+class _DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Раздача записей из очереди по файлам журналов: у каждого логгера свой файл
+class _RoutingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.routes = {}
+
+    def handle(self, record):
+        handler = self.routes.get(record.name)
+        if handler is not None:
+            handler.handle(record)
+        return True
+
+
+_queue = queue.SimpleQueue()
+_router = _RoutingHandler()
+_listener = None
+
+
+def _start_listener():
+    global _listener
+    if _listener is None:
+        _listener = QueueListener(_queue, _router)
+        _listener.start()
+        # При выходе дописываем записи, оставшиеся в очереди
+        atexit.register(_listener.stop)
+
+
+# Создание логгера: запись в файл выполняет фоновый поток, поэтому вызовы журнала
+# в цикле событий не ждут диска
+def create_logger(logger_name, log_file):
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(d.get("log_level", "INFO"))
+    if logger_name not in _router.routes:
+        handler = RotatingFileHandler(log_file, maxBytes=3000000, backupCount=3)
+        if d.get("log_format") == "json":
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+        _router.routes[logger_name] = handler
+        logger.addHandler(_DeferredQueueHandler(_queue))
+        logger.propagate = False
+        _start_listener()
+    return logger
+
+
+# Ограничение частоты однотипных записей: не больше одной на ключ за interval секунд (0 - без ограничения)
+class RateLimiter:
+    def __init__(self, interval):
+        self.interval = interval
+        self._last = {}
+
+    def allow(self, key, now=None):
+        if not self.interval:
+            return True
+        now = now or time.monotonic()
+        last = self._last.get(key)
+        if last is not None and now - last < self.interval:
+            return False
+        self._last[key] = now
+        return True
@@ -0,0 +1,177 @@
+import threading
+from bisect import bisect_left
+from flask import Blueprint, Response
+
+metrics = Blueprint('metrics', __name__)
+
+# Границы интервалов гистограмм, секунды
+MODBUS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SQLITE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+HTTP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CYCLE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+# Счетчики одной гистограммы для одного набора меток. Память под интервалы выделяется один раз,
+# наблюдение - поиск интервала и увеличение счетчиков без создания объектов
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последний интервал - больше всех границ
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+# Метрика с метками. Дочерние счетчики создаются при первом обращении к набору меток,
+# на горячем пути их лучше получить заранее через labels() и сохранить
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(_format_labels(self.labelnames, values), values, child))
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=MODBUS_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value, *values):
+        self.labels(*values).observe(value)
+
+    def _render_child(self, labels, values, child):
+        with child._lock:
+            counts = list(child.counts)
+            total_sum = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames + ('le',), values + (le,))} {cumulative}")
+        lines.append(f"{self.name}_sum{labels} {total_sum}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, *values, amount=1):
+        self.labels(*values).inc(amount)
+
+    def _render_child(self, labels, values, child):
+        return [f"{self.name}{labels} {child.value}"]
+
+
+# Набор метрик для /metrics. Кроме собственных метрик, значения берутся из существующей статистики
+# модулей через функции-сборщики: они возвращают [(имя, тип, описание, [(метки, значение)])]
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def histogram(self, name, help_text, labelnames=(), buckets=MODBUS_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, kind, help_text, samples in collector():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+modbus_request_seconds = registry.histogram(
+    "modbus_request_duration_seconds", "Время запроса Modbus от отправки до ответа", ("slave", "function"))
+modbus_errors = registry.counter(
+    "modbus_request_errors_total", "Неудачные запросы Modbus: timeout, error (ответ с ошибкой), exception",
+    ("slave", "function", "kind"))
+modbus_connect_seconds = registry.histogram(
+    "modbus_connect_duration_seconds", "Время подключения к шлюзу", ("gateway",))
+poll_cycle_seconds = registry.histogram(
+    "poll_cycle_duration_seconds", "Длительность цикла опроса", buckets=CYCLE_BUCKETS)
+sqlite_write_seconds = registry.histogram(
+    "sqlite_write_duration_seconds", "Время записи транзакции SQLite", ("db",), buckets=SQLITE_BUCKETS)
+http_request_seconds = registry.histogram(
+    "http_request_duration_seconds", "Время обработки запроса REST", ("route", "method", "status"),
+    buckets=HTTP_BUCKETS)
+
+
+@metrics.route('/metrics')
+def metrics_endpoint():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
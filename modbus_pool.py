@@ -0,0 +1,252 @@
+import asyncio
+import heapq
+import itertools
+import json
+import time
+import weakref
+from contextlib import asynccontextmanager
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from metrics import modbus_connect_seconds
+from device_profiles import device_gateways
+from modbus_rtu import get_bus, close_buses
+from rtt_estimator import RttEstimator
+from traffic_capture import traffic_capture, replay_source
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+# Ошибки, после которых соединение считается испорченным и закрывается
+BROKEN_ERRORS = (ConnectionException, ModbusIOException, asyncio.TimeoutError, asyncio.CancelledError, OSError)
+
+# Приоритеты ожидания свободного соединения: чем меньше, тем раньше
+PRIORITY_URGENT = 0   # аварийные действия блокировок
+PRIORITY_NORMAL = 10  # опрос и обычные запросы
+
+# Статистика соединений по шлюзам, общая для всех циклов событий
+_stats = {}
+
+# Пулы соединений: цикл событий -> {(host, port): ConnectionPool}
+_pools = weakref.WeakKeyDictionary()
+
+
+def _gateway_stats(host, port):
+    key = f"{host}:{port}"
+    if key not in _stats:
+        _stats[key] = {
+            "connects": 0,          # успешные TCP-подключения
+            "connect_failures": 0,  # неудачные попытки подключения
+            "reconnects": 0,        # переподключения взамен потерянных соединений
+            "acquires": 0,          # выдачи соединения под запрос
+            "reuses": 0,            # выдачи уже открытого соединения
+            "discarded": 0          # закрытые испорченные или устаревшие соединения
+        }
+    return _stats[key]
+
+
+# Пул долгоживущих соединений к одному шлюзу Modbus TCP. Таймаут подключения подстраивается под время
+# подключения к шлюзу так же, как таймауты запросов под время ответа устройств (rtt_estimator)
+class ConnectionPool:
+    def __init__(self, host, port, size=1, connect_timeout=0.3, max_idle=30.0, client_factory=None, name=None):
+        self.host = host
+        self.port = port
+        self.name = name or f"{host}:{port}"  # имя шлюза в журнале обмена
+        self.size = size
+        self.connect_rtt = RttEstimator(f"{host}:{port}", connect_timeout, d["rtt_timeout_min_seconds"],
+                                        d["rtt_timeout_max_seconds"])
+        self.max_idle = max_idle
+        self.client_factory = client_factory or self._create_client
+        self.stats = _gateway_stats(host, port)
+        self._connect_seconds = modbus_connect_seconds.labels(f"{host}:{port}")
+        self._idle = []  # свободные соединения: (client, время последнего использования)
+        self._free = size      # сколько соединений еще можно выдать
+        self._waiters = []     # очередь ожидания: (приоритет, номер, future)
+        self._order = itertools.count()
+        self._leased = 0  # соединения, выданные под запрос
+        self._lost = 0    # потерянные соединения, которые еще не переподключены
+
+    def _create_client(self):
+        # Автоматическое переподключение pymodbus отключено, им управляет пул
+        return AsyncModbusTcpClient(self.host, port=self.port, retries=d["max_retries"], reconnect_delay=0)
+
+    @property
+    def open_connections(self):
+        return len(self._idle) + self._leased
+
+    async def _connect(self):
+        client = self.client_factory()
+        started = time.perf_counter()
+        try:
+            connected = await asyncio.wait_for(client.connect(), timeout=self.connect_rtt.timeout())
+        except BaseException as e:
+            if isinstance(e, asyncio.TimeoutError):
+                self.connect_rtt.timed_out()
+            self.stats["connect_failures"] += 1
+            client.close()
+            raise
+        finally:
+            self._connect_seconds.observe(time.perf_counter() - started)
+        if connected:
+            self.connect_rtt.observe(time.perf_counter() - started)
+        if not connected:
+            self.stats["connect_failures"] += 1
+            client.close()
+            raise ConnectionException(f"Нет соединения со шлюзом {self.host}:{self.port}")
+        self.stats["connects"] += 1
+        if self._lost:
+            self._lost -= 1
+            self.stats["reconnects"] += 1
+        return client
+
+    def _discard(self, client, lost=True):
+        self.stats["discarded"] += 1
+        if lost:
+            self._lost += 1
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    # Берем живое свободное соединение, отбрасывая разорванные и простаивавшие слишком долго
+    def _take_idle(self):
+        now = time.monotonic()
+        while self._idle:
+            client, last_used = self._idle.pop()
+            if client.connected and now - last_used <= self.max_idle:
+                return client
+            self._discard(client, lost=not client.connected)
+        return None
+
+    # Ожидание права на соединение: при нехватке соединений первым получает ожидающий с меньшим приоритетом
+    async def _acquire_slot(self, priority):
+        if self._free > 0:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Право уже передано этой задаче, но она отменена - передаем его следующему
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            raise
+
+    def _release_slot(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
+
+    @asynccontextmanager
+    async def connection(self, priority=PRIORITY_NORMAL):
+        await self._acquire_slot(priority)
+        try:
+            client = self._take_idle()
+            if client is None:
+                client = await self._connect()
+            else:
+                self.stats["reuses"] += 1
+            self.stats["acquires"] += 1
+            self._leased += 1
+            broken = False
+            try:
+                yield traffic_capture.wrap(client, self.name)
+            except BROKEN_ERRORS:
+                broken = True
+                raise
+            finally:
+                self._leased -= 1
+                if broken or not client.connected:
+                    self._discard(client)
+                else:
+                    self._idle.append((client, time.monotonic()))
+        finally:
+            self._release_slot()
+
+    # Проверка состояния свободных соединений
+    def health_check(self):
+        alive = self._idle
+        self._idle = []
+        now = time.monotonic()
+        for client, last_used in alive:
+            if client.connected and now - last_used <= self.max_idle:
+                self._idle.append((client, last_used))
+            else:
+                self._discard(client, lost=not client.connected)
+        return len(self._idle)
+
+    def close(self):
+        while self._idle:
+            client, _ = self._idle.pop()
+            try:
+                client.close()
+            except Exception:
+                pass
+
+
+# Пул соединений к шлюзу для текущего цикла событий
+def get_pool(host=None, port=None, size=None, name=None):
+    host = host or d["server_host"]
+    port = port or d["server_port"]
+    loop = asyncio.get_running_loop()
+    pools = _pools.setdefault(loop, {})
+    if (host, port) not in pools:
+        pools[(host, port)] = ConnectionPool(host, port, size=size or d["pool_size"],
+                                             connect_timeout=d["connection_timeout"],
+                                             max_idle=d["pool_max_idle_seconds"], name=name)
+    return pools[(host, port)]
+
+
+# Пул клиентов воспроизведения журнала обмена вместо шлюза (replay_file в config.json)
+def replay_pool(gateway):
+    pools = _pools.setdefault(asyncio.get_running_loop(), {})
+    if ("replay", gateway.name) not in pools:
+        pools[("replay", gateway.name)] = ConnectionPool("replay", gateway.name, size=gateway.pool_size,
+                                                         client_factory=replay_source.client_factory(gateway.name),
+                                                         name=gateway.name)
+    return pools[("replay", gateway.name)]
+
+
+# Пул соединений к шлюзу или, для шлюза RTU, его последовательная шина: у обоих одинаковый connection()
+def gateway_pool(gateway):
+    if replay_source is not None:
+        return replay_pool(gateway)
+    if gateway.serial is not None:
+        return get_bus(gateway)
+    return get_pool(gateway.host, gateway.port, gateway.pool_size, gateway.name)
+
+
+# Пул соединений к шлюзу, за которым находится прибор
+def device_pool(device):
+    return gateway_pool(device_gateways[device])
+
+
+# Периодическая проверка соединений всех шлюзов текущего цикла событий
+async def health_check_pools():
+    for pool in _pools.get(asyncio.get_running_loop(), {}).values():
+        pool.health_check()
+
+
+# Закрытие пулов и шин RTU текущего цикла событий
+def close_pools():
+    for pool in _pools.pop(asyncio.get_running_loop(), {}).values():
+        pool.close()
+    close_buses()
+
+
+# Число подключений и доля повторного использования по каждому шлюзу
+def pool_stats():
+    result = {}
+    for key, stats in _stats.items():
+        item = dict(stats)
+        item["reuse_ratio"] = round(stats["reuses"] / stats["acquires"], 3) if stats["acquires"] else 0.0
+        pools = [pool for loop_pools in list(_pools.values()) for (host, port), pool in loop_pools.items()
+                 if f"{host}:{port}" == key]
+        item["open_connections"] = sum(pool.open_connections for pool in pools)
+        item["connect_timeout_ms"] = round(pools[0].connect_rtt.timeout() * 1000, 1) if pools else None
+        result[key] = item
+    return result
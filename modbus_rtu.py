@@ -0,0 +1,412 @@
+import asyncio
+import struct
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager
+import serial
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.register_read_message import ReadHoldingRegistersResponse, ReadInputRegistersResponse
+from pymodbus.register_write_message import WriteMultipleRegistersResponse
+from traffic_capture import traffic_capture
+
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+WRITE_MULTIPLE_REGISTERS = 16
+
+# Адрес широковещательной записи: приборы не отвечают, после нее шина выдерживает паузу turnaround
+BROADCAST = 0
+
+# Окно, за которое считается текущая загрузка шины, секунды
+UTILIZATION_WINDOW = 10.0
+
+# Статистика шин, общая для всех циклов событий
+_stats = {}
+
+# Шины: цикл событий -> {имя шлюза: RtuBus}
+_buses = weakref.WeakKeyDictionary()
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+# Контрольная сумма кадра Modbus RTU (CRC-16, младший байт первым)
+def crc16(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return struct.pack("<H", crc)
+
+
+def _bus_stats(name):
+    if name not in _stats:
+        _stats[name] = {
+            "requests": 0,      # выполненные запросы
+            "timeouts": 0,      # запросы без ответа
+            "crc_errors": 0,    # ответы с неверной контрольной суммой или не от того прибора
+            "exceptions": 0,    # ответы прибора с кодом ошибки
+            "dropped": 0,       # запросы, отмененные до отправки
+            "reordered": 0,     # запросы, отправленные раньше ожидавших, пока те ждали паузы прибора
+            "busy_seconds": 0.0  # время занятости шины запросами и ожиданием ответов
+        }
+    return _stats[name]
+
+
+# Запрос в очереди шины
+class _Transaction:
+    def __init__(self, slave, function_code, pdu, response_size, priority, order, future):
+        self.slave = slave
+        self.function_code = function_code
+        self.frame = bytes([slave, function_code]) + pdu
+        self.frame += crc16(self.frame)
+        self.response_size = response_size  # длина кадра ответа без ошибки
+        self.priority = priority
+        self.order = order
+        self.future = future
+        self.latency = None  # время от конца запроса до конца ответа на линии
+
+
+# Клиент шины с интерфейсом AsyncModbusTcpClient в той части, которой пользуется сервис.
+# Шина сама ограничивает ожидание ответа (enforces_timeout): время в ее очереди в таймаут не входит.
+# latency - время последнего ответа на линии, без ожидания в очереди; клиентом пользуется одна задача
+class RtuClient:
+    enforces_timeout = True
+
+    def __init__(self, bus, priority):
+        self.bus = bus
+        self.priority = priority
+        self.latency = None
+
+    @property
+    def connected(self):
+        return self.bus.connected
+
+    async def _execute(self, slave, function_code, pdu, response_size):
+        response, self.latency = await self.bus.execute(slave, function_code, pdu, response_size, self.priority)
+        return response
+
+    async def read_holding_registers(self, address, count=1, slave=1):
+        registers = await self._execute(slave, READ_HOLDING_REGISTERS, struct.pack(">HH", address, count),
+                                        5 + 2 * count)
+        return registers if registers.isError() else ReadHoldingRegistersResponse(registers.registers)
+
+    async def read_input_registers(self, address, count=1, slave=1):
+        registers = await self._execute(slave, READ_INPUT_REGISTERS, struct.pack(">HH", address, count),
+                                        5 + 2 * count)
+        return registers if registers.isError() else ReadInputRegistersResponse(registers.registers)
+
+    async def write_registers(self, address, values, slave=1):
+        values = [int(value) for value in values]
+        pdu = struct.pack(f">HHB{len(values)}H", address, len(values), 2 * len(values), *values)
+        response = await self._execute(slave, WRITE_MULTIPLE_REGISTERS, pdu, 8)
+        return response if response.isError() else WriteMultipleRegistersResponse(address, len(values))
+
+
+# Ответ на чтение до упаковки в ответ pymodbus
+class _Registers:
+    def __init__(self, registers):
+        self.registers = registers
+
+    def isError(self):
+        return False
+
+
+# Последовательная шина RS-485 с прямым обменом Modbus RTU. Порт принадлежит одной задаче-планировщику:
+# запросы всех приборов шины встают в общую очередь, перед каждым кадром выдерживается тишина 3,5 символа,
+# ответ ждется не дольше response_timeout. Прибору после ответа нужно turnaround секунд на подготовку
+# к следующему запросу: пока он занят, планировщик отправляет запросы к другим приборам, если они успеют
+# завершиться до готовности первого, поэтому пауза прибора не простаивает шину
+class RtuBus:
+    def __init__(self, name, port, baudrate=9600, bytesize=8, parity="N", stopbits=1, turnaround=0.0,
+                 response_timeout=0.2, serial_factory=None):
+        self.name = name
+        self.port = port
+        self.baudrate = baudrate
+        self.bytesize = bytesize
+        self.parity = parity
+        self.stopbits = stopbits
+        self.turnaround = turnaround
+        self.response_timeout = response_timeout
+        self.serial_factory = serial_factory or self._open_serial
+        bits = 1 + bytesize + (0 if parity == "N" else 1) + stopbits
+        self.char_time = bits / baudrate
+        # По спецификации Modbus на скоростях выше 19200 бод тишина фиксирована: 1,75 мс
+        self.silence = 3.5 * self.char_time if baudrate <= 19200 else 0.00175
+        self.stats = _bus_stats(name)
+        self._serial = None
+        self._pending = []
+        self._order = 0
+        self._wakeup = asyncio.Event()
+        self._data = asyncio.Event()
+        self._buffer = bytearray()
+        self._task = None
+        self._loop = None
+        self._last_activity = 0.0  # время последнего байта на линии (время цикла событий)
+        self._ready_at = {}        # прибор -> время, с которого он готов принять запрос
+        self._latency = {}         # прибор -> сглаженное время от конца запроса до конца ответа
+        self._busy = deque()       # (конец, длительность) занятости шины за окно UTILIZATION_WINDOW
+        self._started = None
+
+    def _open_serial(self):
+        return serial.Serial(self.port, baudrate=self.baudrate, bytesize=self.bytesize, parity=self.parity,
+                             stopbits=self.stopbits, timeout=0)
+
+    @property
+    def connected(self):
+        return self._serial is not None
+
+    def _open(self):
+        if self._serial is not None:
+            return
+        try:
+            self._serial = self.serial_factory()
+        except (OSError, serial.SerialException) as e:
+            raise ConnectionException(f"Нет доступа к порту {self.port}: {e}")
+        self._buffer.clear()
+        self._loop.add_reader(self._serial.fileno(), self._on_readable)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._serial is not None:
+            try:
+                self._loop.remove_reader(self._serial.fileno())
+                self._serial.close()
+            except Exception:
+                pass
+            self._serial = None
+        for transaction in self._pending:
+            if not transaction.future.done():
+                transaction.future.set_exception(ConnectionException(f"Шина {self.name} закрыта"))
+        self._pending = []
+
+    def _on_readable(self):
+        try:
+            data = self._serial.read(self._serial.in_waiting or 1)
+        except (OSError, serial.SerialException):
+            self._loop.remove_reader(self._serial.fileno())
+            self._serial.close()
+            self._serial = None
+            self._data.set()
+            return
+        if data:
+            self._buffer += data
+            self._last_activity = self._loop.time()
+            self._data.set()
+
+    # priority - как у modbus_pool.ConnectionPool: чем меньше, тем раньше запрос уходит на шину
+    @asynccontextmanager
+    async def connection(self, priority=10):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._started = self._loop.time()
+        self._open()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        yield traffic_capture.wrap(RtuClient(self, priority), self.name)
+
+    # Постановка запроса в очередь шины. Возвращает (ответ, время ответа на линии): ответ - _Registers
+    # или ответ pymodbus с ошибкой прибора; если ответа нет - исключение
+    async def execute(self, slave, function_code, pdu, response_size, priority):
+        if self._serial is None:
+            self._open()
+        future = self._loop.create_future()
+        self._order += 1
+        transaction = _Transaction(slave, function_code, pdu, response_size, priority, self._order, future)
+        self._pending.append(transaction)
+        self._wakeup.set()
+        return await future, transaction.latency
+
+    def _estimate(self, transaction):
+        reply = 0 if transaction.slave == BROADCAST else self._latency.get(transaction.slave, self.response_timeout)
+        return self.silence + len(transaction.frame) * self.char_time + reply
+
+    # Выбор следующего запроса: первым идет запрос с наименьшим (приоритет, номер). Если его прибор еще
+    # не готов, вместо простоя шины отправляется запрос того же приоритета к готовому прибору, а запрос
+    # с меньшим приоритетом - только если по оценке завершится до готовности первого. Первый запрос
+    # задерживается не больше чем на один обмен. Возвращает (запрос, None) или (None, время, до которого ждать)
+    def _select(self, now):
+        pending = [transaction for transaction in self._pending if not transaction.future.done()]
+        self.stats["dropped"] += len(self._pending) - len(pending)
+        self._pending = pending
+        if not pending:
+            return None, None
+        head = min(self._pending, key=lambda transaction: (transaction.priority, transaction.order))
+        head_ready = self._ready_time(head)
+        if head_ready <= now:
+            return head, None
+        fits = [transaction for transaction in self._pending if self._ready_time(transaction) <= now and (
+                transaction.priority <= head.priority or now + self._estimate(transaction) <= head_ready)]
+        if fits:
+            self.stats["reordered"] += 1
+            return min(fits, key=lambda transaction: (transaction.priority, transaction.order)), None
+        return None, head_ready
+
+    def _ready_time(self, transaction):
+        return max(self._ready_at.get(transaction.slave, 0.0), self._ready_at.get(BROADCAST, 0.0))
+
+    async def _run(self):
+        while True:
+            # Тишина на линии перед кадром, в том числе после запоздавших ответов
+            delay = self._last_activity + self.silence - self._loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            transaction, wait_until = self._select(self._loop.time())
+            if transaction is None:
+                self._wakeup.clear()
+                timeout = None if wait_until is None else max(wait_until - self._loop.time(), 0)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._pending.remove(transaction)
+            try:
+                await self._transact(transaction)
+            except asyncio.CancelledError:
+                if not transaction.future.done():
+                    transaction.future.cancel()
+                raise
+
+    async def _transact(self, transaction):
+        if self._serial is None:
+            try:
+                self._open()
+            except ConnectionException as e:
+                transaction.future.set_exception(e)
+                return
+        self._buffer.clear()
+        started = self._loop.time()
+        try:
+            self._serial.write(transaction.frame)
+        except (OSError, serial.SerialException) as e:
+            transaction.future.set_exception(ConnectionException(f"Ошибка записи в порт {self.port}: {e}"))
+            return
+        sent = started + len(transaction.frame) * self.char_time
+        self._last_activity = sent
+        self.stats["requests"] += 1
+        if transaction.slave == BROADCAST:
+            await asyncio.sleep(sent - self._loop.time())
+            self._ready_at[BROADCAST] = sent + self.turnaround
+            self._account(started)
+            if not transaction.future.done():
+                transaction.future.set_result(_Registers([]))
+            return
+        try:
+            response = await self._receive(transaction, sent + self.response_timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            self._account(started)
+            if not transaction.future.done():
+                transaction.future.set_exception(asyncio.TimeoutError())
+            return
+        except ModbusIOException as e:
+            self.stats["crc_errors"] += 1
+            self._account(started)
+            if not transaction.future.done():
+                transaction.future.set_exception(e)
+            return
+        except ConnectionException as e:
+            self._account(started)
+            if not transaction.future.done():
+                transaction.future.set_exception(e)
+            return
+        finished = self._loop.time()
+        latency = finished - sent
+        previous = self._latency.get(transaction.slave)
+        self._latency[transaction.slave] = latency if previous is None else 0.8 * previous + 0.2 * latency
+        transaction.latency = latency
+        self._ready_at[transaction.slave] = finished + self.turnaround
+        self._account(started)
+        if not transaction.future.done():
+            transaction.future.set_result(response)
+
+    # Прием ответа: длина кадра известна по коду функции, кадр с ошибкой прибора короче
+    async def _receive(self, transaction, deadline):
+        while True:
+            size = None
+            if len(self._buffer) >= 2:
+                size = 5 if self._buffer[1] & 0x80 else transaction.response_size
+            if size is not None and len(self._buffer) >= size:
+                return self._parse(transaction, bytes(self._buffer[:size]))
+            if self._serial is None:
+                raise ConnectionException(f"Порт {self.port} закрыт")
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            self._data.clear()
+            await asyncio.wait_for(self._data.wait(), remaining)
+
+    def _parse(self, transaction, frame):
+        if crc16(frame[:-2]) != frame[-2:]:
+            raise ModbusIOException(f"Неверная контрольная сумма ответа прибора {transaction.slave}")
+        if frame[0] != transaction.slave or frame[1] & 0x7F != transaction.function_code:
+            raise ModbusIOException(f"Ответ не соответствует запросу к прибору {transaction.slave}")
+        if frame[1] & 0x80:
+            self.stats["exceptions"] += 1
+            return ExceptionResponse(transaction.function_code, frame[2])
+        if transaction.function_code == WRITE_MULTIPLE_REGISTERS:
+            return _Registers([])
+        count = frame[2] // 2
+        return _Registers(list(struct.unpack(f">{count}H", frame[3:3 + 2 * count])))
+
+    def _account(self, started):
+        finished = self._loop.time()
+        self.stats["busy_seconds"] += finished - started
+        self._busy.append((finished, finished - started))
+        while self._busy and self._busy[0][0] < finished - UTILIZATION_WINDOW:
+            self._busy.popleft()
+
+    # Доля времени занятости шины за последние UTILIZATION_WINDOW секунд
+    def utilization(self):
+        if self._loop is None:
+            return 0.0
+        now = self._loop.time()
+        window = min(UTILIZATION_WINDOW, now - self._started) or UTILIZATION_WINDOW
+        busy = sum(duration for finished, duration in self._busy if finished >= now - window)
+        return round(min(busy / window, 1.0), 3)
+
+    def health_check(self):
+        return int(self.connected)
+
+
+# Шина шлюза RTU для текущего цикла событий
+def get_bus(gateway):
+    loop = asyncio.get_running_loop()
+    buses = _buses.setdefault(loop, {})
+    if gateway.name not in buses:
+        line = gateway.serial
+        buses[gateway.name] = RtuBus(gateway.name, line.port, line.baudrate, line.bytesize, line.parity,
+                                     line.stopbits, line.turnaround, line.response_timeout)
+    return buses[gateway.name]
+
+
+# Закрытие шин текущего цикла событий
+def close_buses():
+    for bus in _buses.pop(asyncio.get_running_loop(), {}).values():
+        bus.close()
+
+
+# Счетчики, текущая загрузка и очередь каждой шины
+def bus_stats():
+    result = {}
+    for name, stats in _stats.items():
+        item = dict(stats, busy_seconds=round(stats["busy_seconds"], 3), utilization=0.0, queued=0, connected=False)
+        for buses in list(_buses.values()):
+            bus = buses.get(name)
+            if bus is not None:
+                item.update(utilization=bus.utilization(), queued=len(bus._pending), connected=bus.connected)
+        result[name] = item
+    return result
@@ -0,0 +1,79 @@
+import asyncio
+import concurrent.futures
+import json
+import threading
+from modbus_pool import close_pools
+from write_queue import write_queue
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+
+# Единый долгоживущий цикл событий, через который идет весь обмен с устройствами.
+# Планировщик опроса работает в этом же цикле, а синхронные обработчики Flask
+# передают в него корутины через submit/run.
+class ModbusService:
+    def __init__(self):
+        self.loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.loop is None:
+                started = threading.Event()
+                self.loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run, args=(started,), name="modbus-io", daemon=True)
+                self._thread.start()
+                started.wait()
+        return self.loop
+
+    # Работа в уже запущенном цикле событий (например, ASGI-сервера) вместо собственного потока
+    def attach(self, loop):
+        with self._lock:
+            if self._thread is not None:
+                raise RuntimeError("Сервис уже работает в собственном потоке")
+            self.loop = loop
+
+    async def detach(self):
+        await self._close()
+        self.loop = None
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(started.set)
+        self.loop.run_forever()
+
+    # Потокобезопасная отправка корутины в цикл сервиса
+    def submit(self, coro):
+        if self.loop is None:
+            self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # Синхронное ожидание результата для обработчиков Flask
+    def run(self, coro, timeout=None):
+        future = self.submit(coro)
+        try:
+            return future.result(timeout if timeout is not None else d["service_request_timeout"])
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self.loop = None
+            self._thread = None
+
+    async def _close(self):
+        await write_queue.close()
+        close_pools()
+
+
+modbus_service = ModbusService()
@@ -1,12 +1,25 @@
 import json
 import os
 import sqlite3
-import logging
-from logging.handlers import RotatingFileHandler
 import asyncio
+import time
 from flask import Blueprint
 from locks import device_locks
-from pymodbus.client import AsyncModbusTcpClient
+from modbus_pool import gateway_pool, device_pool, pool_stats
+from modbus_rtu import bus_stats
+from read_plan import compile_plan, plan_by_device, execute_request, slice_registers
+from device_profiles import device_params, device_labs, device_gateways, lab_devices, lab_unit_id
+from value_cache import value_cache
+from history import history_store
+from stream import broadcaster
+from interlocks import interlock_engine
+from circuit_breaker import device_breakers
+from rtt_estimator import device_rtts
+from poll_schedule import poll_schedule, deadband
+from write_queue import write_queue
+from metrics import registry, poll_cycle_seconds, sqlite_write_seconds
+from log_queue import create_logger, RateLimiter
+from workers import worker_role
 from pymodbus.exceptions import ConnectionException
 
 poll_params = Blueprint('poll_params', __name__)
@@ -16,28 +29,42 @@ with open('config.json') as f:
     d = json.load(f)
 
 
-# Создание логгера
-def create_logger(logger_name, log_file):
-    logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.INFO)
-    handler = RotatingFileHandler(log_file, maxBytes=3000000, backupCount=3)
-    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-    logger.addHandler(handler)
-    return logger
-
-
 poll_logger = create_logger("poll_params_logger", "poll_params.log")
 
+# Значения параметров пишутся в журнал не чаще раза в log_sample_interval_seconds на параметр
+sample_log_limit = RateLimiter(d["log_sample_interval_seconds"])
+
 
 # В случае ошибки записываем в логгер
 def log_error(code, message):
-    poll_logger.error(f'Ошибка {code}: {message}')
+    poll_logger.error('Ошибка %s: %s', code, message)
 
 
 # Создание базы данных
 DB_FILE = 'params.db'
 UNITS_DB_FILE = 'units.db'
 
+# Метрики времени записи в базы: получаются один раз, запись каждого цикла их не ищет
+params_write_seconds = sqlite_write_seconds.labels("params")
+units_write_seconds = sqlite_write_seconds.labels("units")
+
+
+# Постоянные соединения с базами данных, которыми владеет цикл опроса
+_db_connections = {}
+
+# Последний записанный статус доступности установок
+_unit_availability = {}
+
+
+def _db(db_file):
+    if db_file not in _db_connections:
+        conn = sqlite3.connect(db_file)
+        # В режиме WAL фиксация транзакции не требует fsync каждый раз
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_connections[db_file] = conn
+    return _db_connections[db_file]
+
 
 # Создание таблицы базы данных
 def init_params_db():
@@ -52,6 +79,11 @@ def init_params_db():
             equipment_id INT NOT NULL
         )
     """)
+    # Оставляем по одной строке на параметр, чтобы построить уникальный индекс
+    cursor.execute("""
+        DELETE FROM static_params WHERE id NOT IN (SELECT MIN(id) FROM static_params GROUP BY param_name)
+    """)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS static_params_param_name ON static_params (param_name)")
     conn.commit()
     conn.close()
 
@@ -66,185 +98,265 @@ def init_units_db():
             availability BOOLEAN NOT NULL
         )
     """)
-    cursor.execute("INSERT OR IGNORE INTO units (unit_id, availability) VALUES (13, 0)")
-    cursor.execute("INSERT OR IGNORE INTO units (unit_id, availability) VALUES (14, 0)")
+    for lab_num in d["labs"]:
+        cursor.execute("INSERT OR IGNORE INTO units (unit_id, availability) VALUES (?, 0)", (lab_unit_id(lab_num),))
     conn.commit()
     conn.close()
 
 
-# Обновление статуса доступности в units.db
-def update_unit_availability(unit_id, availability):
-    conn = sqlite3.connect(UNITS_DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE units SET availability = ? WHERE unit_id = ?", (availability, unit_id))
-    conn.commit()
-    conn.close()
+# Обновление статуса доступности в units.db: записываются только изменившиеся значения
+def update_unit_availability(availability):
+    changed = [(available, unit_id) for unit_id, available in availability.items()
+               if _unit_availability.get(unit_id) != available]
+    if not changed:
+        return
+    started = time.perf_counter()
+    conn = _db(UNITS_DB_FILE)
+    with conn:
+        conn.executemany("UPDATE units SET availability = ? WHERE unit_id = ?", changed)
+    units_write_seconds.observe(time.perf_counter() - started)
+    _unit_availability.update(availability)
 
 
 init_params_db()
 init_units_db()
 
 
-# Функция сохранения данных
-def save_to_db(param_name, value):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""SELECT COUNT(*) FROM static_params WHERE param_name = ?""", (param_name,))
-    exists = cursor.fetchone()[0] > 0
-    if exists:
-        cursor.execute("""UPDATE static_params SET value = ? WHERE param_name = ?""", (value, param_name))
-    else:
-        lab = 14
-        if param_name == "T" or param_name == "P":
-            lab = 13
-        cursor.execute("""INSERT INTO static_params (param_name, type, value, equipment_id) VALUES (?, 1, ?, ?)""",
-                       (param_name, value, lab))
-    conn.commit()
-    conn.close()
+# Функция сохранения данных: все значения цикла записываются одной транзакцией
+def save_to_db(data):
+    rows = [(param_name, value, lab_unit_id(device_labs[device_params[param_name].device]))
+            for param_name, value, _ in data]
+    started = time.perf_counter()
+    conn = _db(DB_FILE)
+    with conn:
+        conn.executemany("""
+            INSERT INTO static_params (param_name, type, value, equipment_id) VALUES (?, 1, ?, ?)
+            ON CONFLICT (param_name) DO UPDATE SET value = excluded.value
+        """, rows)
+    params_write_seconds.observe(time.perf_counter() - started)
 
 
-# Хранение информации о данных для считывания
-params_to_read = {
-    "trm202": ["lab13", ["T", d["lab13"]["trm202"]["first_register"]]],
-    "pressure_sensor": ["lab13", ["P", d["lab13"]["pressure_sensor"]["first_register"]]],
-    "trm200": ["lab14", ["T1", d["lab14"]["trm200"]["first_register"]],
-               ["T2", d["lab14"]["trm200"]["second_register"]]],
-    "sensor": ["lab14", ["DP", d["lab14"]["sensor"]["first_register"]]],
-    "trm210": ["lab14", ["p", d["lab14"]["trm210"]["first_register"]]]
-}
+# Планы чтения для наборов параметров, которые пора опрашивать: соседние регистры одного устройства
+# читаются одним запросом, запросы сгруппированы по шлюзам: {шлюз: {устройство: [запросы]}}.
+# Наборов немного, поэтому каждый план составляется один раз
+_read_plans = {}
+
+
+def _read_plan(param_names):
+    key = frozenset(param_names)
+    if key not in _read_plans:
+        plan = plan_by_device(compile_plan([device_params[name] for name in sorted(key)],
+                                           gap_tolerance=d["read_gap_tolerance"]))
+        by_gateway = {}
+        for device, requests in plan.items():
+            by_gateway.setdefault(device_gateways[device], {})[device] = requests
+        _read_plans[key] = by_gateway
+    return _read_plans[key]
+
 
 # Глобальное состояние доступности устройств
-device_status = {
-    "trm202": False,
-    "pressure_sensor": False,
-    "trm200": False,
-    "sensor": False,
-    "trm210": False
+device_status = {device: False for device in device_labs}
+
+# Приборы каждой лабораторной установки для расчета ее доступности
+_unit_devices = {lab_num: lab_devices(lab_num) for lab_num in d["labs"]}
+
+
+# Ограничения числа одновременных запросов опроса к каждому шлюзу
+_gateway_limits = {}
+
+# Статистика циклов опроса
+poll_stats = {
+    "cycles": 0,              # завершенные циклы опроса
+    "overruns": 0,            # циклы, прерванные по крайнему сроку
+    "skipped": 0,             # запуски, пропущенные планировщиком
+    "cancelled_devices": 0,   # опросы устройств, прерванные по крайнему сроку
+    "deadband_suppressed": 0,  # значения, не записанные из-за зоны нечувствительности
+    "last_cycle_seconds": 0.0,
+    "max_cycle_seconds": 0.0
 }
 
+# Статистика опроса по шлюзам
+gateway_poll_stats = {}
 
-async def _read_params():
-    devices = list(params_to_read.keys())
-    host = d["server_host"]
-    port = d["server_port"]
-    answer = []
 
-    # Временное состояние для текущего опроса
-    current_device_status = {device: False for device in devices}
-
-    for device in devices:
-        lab_num = params_to_read.get(device)[0]
-        slave_id = d[lab_num][device]["slave_id"]
-        start_addresses = [params_to_read.get(device)[i][1] for i in range(1, len(params_to_read.get(device)))]
-        client = None
-        device_success = False
-        async with device_locks[device]:
-            try:
-                client = AsyncModbusTcpClient(host, port=port)
-                # Устанавливаем таймаут подключения, например, 0.3 секунды
-                await asyncio.wait_for(client.connect(), timeout=0.3)
-
-                for j, start_address in enumerate(start_addresses):
+def _gateway_limit(gateway):
+    if gateway.name not in _gateway_limits:
+        _gateway_limits[gateway.name] = asyncio.Semaphore(gateway.concurrency)
+    return _gateway_limits[gateway.name]
+
+
+# Опрос одного устройства по запросам плана: прочитанные значения сразу добавляются в answer,
+# ошибки чтения параметров - в errors. Недоступные устройства пропускаются до времени пробного опроса
+async def _read_device(device, requests, pool, limit, answer, errors):
+    breaker = device_breakers[device]
+    if not breaker.allow():
+        _set_errors(errors, [spec for request in requests for spec in request.params], "Устройство недоступно")
+        return False
+    progress = {"sent": False}
+    try:
+        device_success = await _query_device(device, requests, pool, limit, answer, errors, progress)
+    except asyncio.CancelledError:
+        # Опрос, прерванный по крайнему сроку до первого запроса (прибор был занят командой записи),
+        # ничего не говорит о приборе и неудачным не считается; прерванный после - считается
+        if progress["sent"]:
+            breaker.record(False)
+        else:
+            breaker.cancel_probe()
+        raise
+    except Exception:
+        breaker.record(False)
+        raise
+    breaker.record(device_success)
+    return device_success
+
+
+# Блокировка прибора берется раньше места в ограничении шлюза: пока прибор занят командой записи,
+# его опрос не занимает место, нужное опросу других приборов шлюза
+async def _query_device(device, requests, pool, limit, answer, errors, progress):
+    device_success = False
+    async with device_locks[device], limit:
+        try:
+            # Берем долгоживущее соединение из пула шлюза
+            async with pool.connection() as client:
+                for request in requests:
                     try:
-                        count = 1
-                        if device == "trm200" or device == "pressure_sensor":
-                            count = 2 if j == 0 else 1
-
-                        print(f"Запрос на {device} отправлен, адрес: {start_address}, count: {count}")
-                        # Устанавливаем таймаут для чтения данных, например, 0.2 секунды
-                        if device == "sensor":
-                            data = await asyncio.wait_for(
-                                client.read_input_registers(address=start_address, count=count, slave=slave_id),
-                                timeout=0.2
-                            )
-                        else:
-                            data = await asyncio.wait_for(
-                                client.read_holding_registers(address=start_address, count=count, slave=slave_id),
-                                timeout=0.2
-                            )
+                        progress["sent"] = True
+                        data = await execute_request(client, request)
 
                         if not data.isError():
-                            if device == "trm202" or device == "trm200" or device == "trm210":
-                                value = data.registers[0] / 10
-                            elif device == "sensor":
-                                value = data.registers[0]
-                            else:
-                                value = client.convert_from_registers(data.registers, data_type=client.DATATYPE.FLOAT32)
-                                value = round(value, 1)
-
-                            param_name = params_to_read.get(device)[j + 1][0]
-                            poll_logger.info(
-                                f"Получение параметров, прибор {device}, параметр {param_name}, "
-                                f"регистр {start_address}, прочитано значение {value}"
-                            )
-
-                            temp_data = (param_name, value)
-                            answer.append(temp_data)
-                            device_success = True
-
-                            # Проверка давления
-                            if param_name == "P" and value > 2000:
-                                print("насос выключить!")
-                                await client.write_registers(address=8, values=[1], slave=16)
-                                await client.write_registers(address=10, values=[0], slave=16)
-                                await asyncio.sleep(1)
-                                await client.write_registers(address=10, values=[1000], slave=16)
-                                await client.write_registers(address=9, values=[0], slave=16)
-                                print("насос экстренно вырублен")
+                            for spec, registers in slice_registers(request, data.registers):
+                                value = spec.decode(registers)
+
+                                if sample_log_limit.allow(spec.name):
+                                    poll_logger.info("Получение параметров, прибор %s, параметр %s, регистр %s, "
+                                                     "прочитано значение %s", device, spec.name, spec.address, value)
+
+                                timestamp = time.time()
+                                # Блокировки проверяются до всего остального: их действия уходят в срочную
+                                # очередь записи и не зависят от крайнего срока цикла опроса
+                                interlock_engine.on_sample(spec.name, value, timestamp)
+                                temp_data = (spec.name, value, timestamp)
+                                answer.append(temp_data)
+                                value_cache.update(spec.name, value, timestamp)
+                                device_success = True
+                        else:
+                            _set_errors(errors, request.params, f"Ошибка: {data}")
 
                     except asyncio.TimeoutError:
-                        param_name = params_to_read.get(device)[j + 1][0]
-                        poll_logger.error(
-                            f"Таймаут чтения: прибор {device}, параметр {param_name}, регистр {start_address}"
-                        )
+                        poll_logger.error("Таймаут чтения: прибор %s, параметры %s, регистр %s", device,
+                                          ", ".join(spec.name for spec in request.params), request.address)
+                        _set_errors(errors, request.params, "Нет ответа от устройства")
                         continue
                     except Exception as e:
-                        param_name = params_to_read.get(device)[j + 1][0]
-                        poll_logger.error(
-                            f"Ошибка чтения: прибор {device}, параметр {param_name}, "
-                            f"регистр {start_address}: {str(e)}"
-                        )
+                        poll_logger.error("Ошибка чтения: прибор %s, параметры %s, регистр %s: %s", device,
+                                          ", ".join(spec.name for spec in request.params), request.address, str(e))
+                        _set_errors(errors, request.params, str(e))
                         continue
 
-                if device_success:
-                    current_device_status[device] = True
-
-            except asyncio.TimeoutError:
-                log_error(502, f"Таймаут подключения к {device}")
-                current_device_status[device] = False
-            except ConnectionException:
-                log_error(502, f"Ошибка подключения к {device}")
-                current_device_status[device] = False
-            except Exception as e:
-                log_error(502, f"Ошибка Modbus для {device}: {str(e)}")
-                current_device_status[device] = False
-            finally:
-                if client and client.connected:
-                    client.close()
-
-            if not device_success:
-                print(f"Ошибка получения данных с устройства {device}")
-                log_error(500, f"Не удалось получить данные с устройства {device}")
-
-    # Обновляем глобальный статус
-    for device in devices:
-        if current_device_status[device]:
-            device_status[device] = True
-        elif not any(device in [x[0] for x in answer] for x in answer):
-            device_status[device] = False
-
-    # Определяем доступность для lab13 и lab14
-    lab13_devices = [dev for dev in devices if params_to_read[dev][0] == "lab13"]
-    lab14_devices = [dev for dev in devices if params_to_read[dev][0] == "lab14"]
-
-    lab13_availability = any(device_status[dev] for dev in lab13_devices)
-    lab14_availability = any(device_status[dev] for dev in lab14_devices)
-
-    update_unit_availability(13, lab13_availability)
-    update_unit_availability(14, lab14_availability)
-
-    print(f"Текущий статус устройств: {device_status}")
-    print(f"Доступность lab13: {lab13_availability}, lab14: {lab14_availability}")
+        except asyncio.TimeoutError:
+            log_error(502, f"Таймаут подключения к {device}")
+            _set_errors(errors, [spec for request in requests for spec in request.params], "Таймаут подключения")
+        except ConnectionException:
+            log_error(502, f"Ошибка подключения к {device}")
+            _set_errors(errors, [spec for request in requests for spec in request.params], "Нет соединения с устройством")
+        except Exception as e:
+            log_error(502, f"Ошибка Modbus для {device}: {str(e)}")
+            _set_errors(errors, [spec for request in requests for spec in request.params], f"Ошибка Modbus: {str(e)}")
+
+        if not device_success:
+            log_error(500, f"Не удалось получить данные с устройства {device}")
+    return device_success
+
+
+def _set_errors(errors, specs, message):
+    for spec in specs:
+        errors[spec.name] = message
+
+
+# Чтение произвольного набора параметров: регистры одного устройства объединяются в общие запросы,
+# устройства читаются одновременно. Возвращает [(param_name, value, timestamp)] и {param_name: ошибка}
+async def read_params(specs):
+    answer = []
+    errors = {}
+    plan = plan_by_device(compile_plan(specs, gap_tolerance=d["read_gap_tolerance"]))
+    await asyncio.gather(*(_read_device(device, requests, device_pool(device), _gateway_limit(device_gateways[device]),
+                                        answer, errors)
+                           for device, requests in plan.items()))
+    return answer, errors
+
+
+# Опрос устройств одного шлюза отдельной задачей: у каждого шлюза свой пул соединений, свое ограничение
+# одновременных запросов и свой крайний срок, поэтому медленный шлюз не задерживает остальные.
+# Возвращает устройства, ответившие в этом цикле, и признак прерывания по крайнему сроку
+async def _poll_gateway(gateway, plan, answer, errors):
+    started = time.monotonic()
+    pool = gateway_pool(gateway)
+    limit = _gateway_limit(gateway)
+    tasks = {asyncio.ensure_future(_read_device(device, requests, pool, limit, answer, errors)): device
+             for device, requests in plan.items()}
+    done, pending = await asyncio.wait(tasks, timeout=d["poll_cycle_deadline"])
+    if pending:
+        for task in pending:
+            task.cancel()
+            log_error(504, f"Опрос устройства {tasks[task]} прерван по крайнему сроку цикла")
+        await asyncio.wait(pending)
+        poll_stats["cancelled_devices"] += len(pending)
+
+    cycle_seconds = time.monotonic() - started
+    stats = gateway_poll_stats.setdefault(gateway.name, {"cycles": 0, "overruns": 0, "devices": 0,
+                                                         "last_cycle_seconds": 0.0, "max_cycle_seconds": 0.0})
+    stats["cycles"] += 1
+    stats["overruns"] += 1 if pending else 0
+    stats["devices"] = len(plan)
+    stats["last_cycle_seconds"] = round(cycle_seconds, 3)
+    stats["max_cycle_seconds"] = round(max(stats["max_cycle_seconds"], cycle_seconds), 3)
+    responded = {tasks[task] for task in done if not task.cancelled() and task.exception() is None and task.result()}
+    return responded, bool(pending)
+
+
+async def _read_params():
+    started = time.monotonic()
+    # Читаем только параметры, у которых подошел срок по их интервалу опроса
+    due = poll_schedule.due(started)
+    if not due:
+        return None
+    read_plan = _read_plan(due)
+    answer = []
+
+    # Опрашиваем все шлюзы одновременно, устройства каждого шлюза - не дольше крайнего срока цикла
+    errors = {}
+    results = await asyncio.gather(*(_poll_gateway(gateway, plan, answer, errors)
+                                     for gateway, plan in read_plan.items()))
+    if any(overrun for _, overrun in results):
+        poll_stats["overruns"] += 1
+    responded = set()
+    for gateway_responded, _ in results:
+        responded |= gateway_responded
+
+    for param_name, value, _ in answer:
+        poll_schedule.observe(param_name, value)
+    poll_schedule.polled(due, started)
+
+    cycle_seconds = time.monotonic() - started
+    poll_cycle_seconds.labels().observe(cycle_seconds)
+    poll_stats["cycles"] += 1
+    poll_stats["last_cycle_seconds"] = round(cycle_seconds, 3)
+    poll_stats["max_cycle_seconds"] = round(max(poll_stats["max_cycle_seconds"], cycle_seconds), 3)
+
+    # Обновляем глобальный статус опрошенных в этом цикле устройств
+    for plan in read_plan.values():
+        for device in plan:
+            device_status[device] = device in responded
+    worker_role.publish_status(device_status)
+
+    # Определяем доступность каждой лабораторной установки (в том числе по приборам, не опрошенным в этом цикле)
+    availability = {}
+    for lab_num, devices in _unit_devices.items():
+        availability[lab_unit_id(lab_num)] = any(device_status[device] for device in devices)
+
+    update_unit_availability(availability)
+
+    poll_logger.debug("Текущий статус устройств: %s, доступность установок: %s", dict(device_status), availability)
 
     # await asyncio.sleep(0.2)
     return answer if answer else None
@@ -254,11 +366,14 @@ async def scheduled_task():
     try:
         data = await _read_params()
         if data:
-            print(data)
-            for answer in data:
-                save_to_db(answer[0], answer[1])
-        else:
-            print("Нет данных для сохранения")
+            # Кэш, блокировки и история получают все значения, а в базу и поток уходят
+            # только вышедшие за зону нечувствительности
+            history_store.append(data)
+            filtered = deadband.filter(data)
+            poll_stats["deadband_suppressed"] += len(data) - len(filtered)
+            if filtered:
+                save_to_db(filtered)
+                broadcaster.publish(filtered)
     except Exception as e:
         log_error(500, f"Ошибка в scheduled_task: {str(e)}")
 
@@ -270,4 +385,77 @@ def delete_logs():
     for file in os.listdir(log_dir):
         file_path = os.path.join(log_dir, file)
         if os.path.isfile(file_path):
-            os.remove(file_path)
\ No newline at end of file
+            os.remove(file_path)
+
+
+# Статистика соединений с шлюзами
+@poll_params.route('/stats/connections')
+def connection_stats():
+    return pool_stats()
+
+
+# Загрузка и счетчики шин Modbus RTU
+@poll_params.route('/stats/buses')
+def serial_bus_stats():
+    return bus_stats()
+
+
+# Учет запусков опроса, пропущенных планировщиком
+def count_skipped_cycle(event):
+    if event.job_id == "poll_params":
+        poll_stats["skipped"] += 1
+
+
+# Статистика циклов опроса
+@poll_params.route('/stats/poll')
+def cycle_stats():
+    return dict(poll_stats, gateways=gateway_poll_stats)
+
+
+# Состояние автоматов отключения опроса устройств
+@poll_params.route('/stats/devices')
+def device_stats():
+    return {device: dict(breaker.status(), available=device_status[device], rtt=device_rtts[device].status())
+            for device, breaker in device_breakers.items()}
+
+
+# Состояние блокировок и времена их срабатывания
+@poll_params.route('/stats/interlocks')
+def interlock_stats():
+    return interlock_engine.status()
+
+
+# Статистика опроса, соединений, устройств, блокировок и очереди записи для /metrics
+def collect_metrics():
+    gateways = pool_stats()
+    for name in ("connects", "connect_failures", "reconnects", "acquires", "reuses", "discarded"):
+        yield (f"modbus_pool_{name}_total", "counter", f"Соединения со шлюзом: {name}",
+               [({"gateway": gateway}, stats[name]) for gateway, stats in gateways.items()])
+    yield ("modbus_pool_open_connections", "gauge", "Открытые соединения со шлюзом",
+           [({"gateway": gateway}, stats["open_connections"]) for gateway, stats in gateways.items()])
+    buses = bus_stats()
+    for name in ("requests", "timeouts", "crc_errors", "exceptions", "dropped", "reordered"):
+        yield (f"modbus_rtu_{name}_total", "counter", f"Запросы шины RTU: {name}",
+               [({"bus": bus}, stats[name]) for bus, stats in buses.items()])
+    yield ("modbus_rtu_busy_seconds_total", "counter", "Время занятости шины RTU",
+           [({"bus": bus}, stats["busy_seconds"]) for bus, stats in buses.items()])
+    yield ("modbus_rtu_utilization", "gauge", "Загрузка шины RTU за последние 10 секунд",
+           [({"bus": bus}, stats["utilization"]) for bus, stats in buses.items()])
+    for name in ("cycles", "overruns", "skipped", "cancelled_devices", "deadband_suppressed"):
+        yield f"poll_{name}_total", "counter", f"Циклы опроса: {name}", [({}, poll_stats[name])]
+    yield ("device_available", "gauge", "Доступность устройства по последнему опросу",
+           [({"device": device}, int(available)) for device, available in device_status.items()])
+    yield ("device_breaker_open", "gauge", "Опрос устройства приостановлен автоматом отключения",
+           [({"device": device}, int(breaker.state != "closed")) for device, breaker in device_breakers.items()])
+    yield ("device_rtt_seconds", "gauge", "Сглаженное время ответа устройства",
+           [({"device": device}, round(rtt.srtt, 4)) for device, rtt in device_rtts.items() if rtt.srtt is not None])
+    yield ("device_timeout_seconds", "gauge", "Текущий таймаут запроса к устройству",
+           [({"device": device}, round(rtt.timeout(), 4)) for device, rtt in device_rtts.items()])
+    yield ("interlock_trips_total", "counter", "Срабатывания блокировок",
+           [({"rule": rule.name}, rule.trips) for rules in interlock_engine.rules.values() for rule in rules])
+    for name in ("executed", "failed", "coalesced"):
+        yield (f"write_queue_{name}_total", "counter", f"Команды очереди записи: {name}",
+               [({"lane": lane}, stats[name]) for lane, stats in write_queue.stats.items()])
+
+
+registry.add_collector(collect_metrics)
@@ -0,0 +1,73 @@
+import json
+import time
+from device_profiles import poll_options, POLL_TICK
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+
+# Расписание опроса параметров. У каждого параметра свой интервал; в адаптивном режиме интервал
+# сразу уменьшается до наименьшего, когда значение меняется сильнее зоны нечувствительности,
+# и удваивается (до заданного интервала), пока значение стоит на месте
+class PollSchedule:
+    def __init__(self, options, tick):
+        self.options = options
+        self.tick = tick
+        self.intervals = {name: option.interval for name, option in options.items()}
+        self._due = {name: 0.0 for name in options}
+        self._last = {}
+
+    # Параметры, которые пора читать в цикле, запущенном в момент now
+    def due(self, now=None):
+        # Половина шага планировщика - допуск на неравномерность его запусков
+        limit = (now or time.monotonic()) + self.tick / 2
+        return [name for name, due_at in self._due.items() if due_at <= limit]
+
+    # Все параметры будут прочитаны в следующем цикле
+    def reset(self):
+        for param_name in self._due:
+            self._due[param_name] = 0.0
+
+    # Подстройка интервала адаптивного параметра по новому значению
+    def observe(self, param_name, value):
+        option = self.options[param_name]
+        previous = self._last.get(param_name)
+        self._last[param_name] = value
+        if option.min_interval is None or previous is None:
+            return
+        if abs(value - previous) > (option.deadband or 0):
+            self.intervals[param_name] = max(option.min_interval, self.tick)
+        else:
+            self.intervals[param_name] = min(self.intervals[param_name] * 2, option.interval)
+
+    # Следующее чтение опрошенных параметров - через их текущий интервал от начала цикла
+    def polled(self, param_names, started):
+        for param_name in param_names:
+            self._due[param_name] = started + self.intervals[param_name]
+
+
+# Фильтр значений для записи в базу и рассылки в поток: значение, отличающееся от последнего записанного
+# не больше чем на зону нечувствительности, пропускается, но не дольше heartbeat секунд
+class Deadband:
+    def __init__(self, options, heartbeat):
+        self.options = options
+        self.heartbeat = heartbeat
+        self._written = {}  # param_name -> (значение, время)
+
+    def filter(self, samples):
+        result = []
+        for sample in samples:
+            param_name, value, timestamp = sample
+            deadband = self.options[param_name].deadband
+            written = self._written.get(param_name)
+            if (deadband is not None and written is not None and abs(value - written[0]) <= deadband
+                    and timestamp - written[1] < self.heartbeat):
+                continue
+            self._written[param_name] = (value, timestamp)
+            result.append(sample)
+        return result
+
+
+poll_schedule = PollSchedule(poll_options, POLL_TICK)
+deadband = Deadband(poll_options, d["deadband_heartbeat_seconds"])
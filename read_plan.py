@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections import namedtuple
+from metrics import modbus_request_seconds, modbus_errors
+from rtt_estimator import device_rtts
+
+# Максимальное число регистров в одном запросе чтения Modbus
+MAX_REGISTERS = 125
+
+# Коды функций чтения
+HOLDING_REGISTERS = 3
+INPUT_REGISTERS = 4
+
+# Читаемый параметр: имя, устройство, адрес slave, код функции, первый регистр, число регистров
+# и функция перевода регистров в значение
+ParamSpec = namedtuple("ParamSpec", ["name", "device", "slave_id", "function_code", "address", "count", "decode"],
+                       defaults=(None,))
+
+# Один запрос чтения, параметры, которые извлекаются из его ответа, и метрики запроса (RequestMetrics)
+ReadRequest = namedtuple("ReadRequest", ["slave_id", "function_code", "address", "count", "params", "metrics"])
+
+
+# Дочерние метрики запросов к одному slave с одним кодом функции. Получаются один раз, при составлении
+# плана, поэтому выполнение запроса не ищет их по меткам
+class RequestMetrics:
+    __slots__ = ("seconds", "timeouts", "exceptions", "errors")
+
+    def __init__(self, slave_id, function_code):
+        self.seconds = modbus_request_seconds.labels(slave_id, function_code)
+        self.timeouts = modbus_errors.labels(slave_id, function_code, "timeout")
+        self.exceptions = modbus_errors.labels(slave_id, function_code, "exception")
+        self.errors = modbus_errors.labels(slave_id, function_code, "error")
+
+
+_request_metrics = {}
+
+
+def request_metrics(slave_id, function_code):
+    key = (slave_id, function_code)
+    if key not in _request_metrics:
+        _request_metrics[key] = RequestMetrics(slave_id, function_code)
+    return _request_metrics[key]
+
+
+# Составление плана чтения: параметры группируются по прибору и коду функции (один slave_id
+# может встречаться за разными шлюзами), а близко расположенные регистры объединяются в один запрос
+def compile_plan(specs, gap_tolerance=0, max_registers=MAX_REGISTERS):
+    groups = {}
+    for spec in specs:
+        groups.setdefault((spec.device, spec.slave_id, spec.function_code), []).append(spec)
+
+    plan = []
+    for (_, slave_id, function_code), items in groups.items():
+        metrics = request_metrics(slave_id, function_code)
+        items.sort(key=lambda item: (item.address, item.count))
+        start = items[0].address
+        end = start + items[0].count
+        members = [items[0]]
+        for spec in items[1:]:
+            spec_end = spec.address + spec.count
+            # Объединяем, если промежуток не больше допустимого и запрос не превышает лимит Modbus
+            if spec.address - end <= gap_tolerance and max(end, spec_end) - start <= max_registers:
+                end = max(end, spec_end)
+                members.append(spec)
+            else:
+                plan.append(ReadRequest(slave_id, function_code, start, end - start, tuple(members), metrics))
+                start, end, members = spec.address, spec_end, [spec]
+        plan.append(ReadRequest(slave_id, function_code, start, end - start, tuple(members), metrics))
+    return plan
+
+
+# Запрос чтения одного параметра
+def single_request(spec):
+    return ReadRequest(spec.slave_id, spec.function_code, spec.address, spec.count, (spec,),
+                       request_metrics(spec.slave_id, spec.function_code))
+
+
+# Разбиение плана по устройствам
+def plan_by_device(plan):
+    result = {}
+    for request in plan:
+        result.setdefault(request.params[0].device, []).append(request)
+    return result
+
+
+# Выполнение одного запроса плана. Без timeout таймаут берется из оценки времени ответа устройства,
+# которая уточняется по каждому ответу. Шина RTU (клиент с enforces_timeout) ограничивает ожидание ответа сама,
+# а запрос перед отправкой ждет в ее очереди, поэтому такой запрос без timeout не прерывается по оценке,
+# а оценка уточняется по времени ответа на линии
+async def execute_request(client, request, timeout=None):
+    rtt = device_rtts[request.params[0].device]
+    on_wire = getattr(client, "enforces_timeout", False)
+    if timeout is None and not on_wire:
+        timeout = rtt.timeout()
+    if request.function_code == INPUT_REGISTERS:
+        call = client.read_input_registers(address=request.address, count=request.count, slave=request.slave_id)
+    else:
+        call = client.read_holding_registers(address=request.address, count=request.count, slave=request.slave_id)
+    started = time.perf_counter()
+    try:
+        response = await (call if timeout is None else asyncio.wait_for(call, timeout=timeout))
+    except asyncio.TimeoutError:
+        rtt.timed_out()
+        request.metrics.timeouts.inc()
+        raise
+    except Exception:
+        request.metrics.exceptions.inc()
+        raise
+    elapsed = time.perf_counter() - started
+    rtt.observe(client.latency if on_wire else elapsed)
+    request.metrics.seconds.observe(elapsed)
+    if response.isError():
+        request.metrics.errors.inc()
+    return response
+
+
+# Нарезка ответа на регистры отдельных параметров
+def slice_registers(request, registers):
+    result = []
+    for spec in request.params:
+        offset = spec.address - request.address
+        result.append((spec, registers[offset:offset + spec.count]))
+    return result
@@ -0,0 +1,56 @@
+import json
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+# Коэффициенты сглаживания из RFC 6298 и множитель разброса в таймауте
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+
+
+# Оценка времени ответа устройства по образцу TCP (RFC 6298): сглаженное время ответа srtt и его разброс rttvar
+# обновляются по каждому ответу, таймаут запроса srtt + K * rttvar ограничен снизу floor и сверху ceiling.
+# После таймаута он удваивается (до ceiling) до следующего ответа, поэтому временно замедлившееся устройство
+# не получает таймаут за таймаутом. До первого ответа используется initial
+class RttEstimator:
+    def __init__(self, name, initial, floor, ceiling):
+        self.name = name
+        self.floor = floor
+        self.ceiling = ceiling
+        self.srtt = None
+        self.rttvar = None
+        self.rto = min(max(initial, floor), ceiling)
+        self.samples = 0
+        self.timeouts = 0
+
+    def timeout(self):
+        return self.rto
+
+    def observe(self, seconds):
+        if self.srtt is None:
+            self.srtt = seconds
+            self.rttvar = seconds / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - seconds)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * seconds
+        self.rto = min(max(self.srtt + K * self.rttvar, self.floor), self.ceiling)
+        self.samples += 1
+
+    def timed_out(self):
+        self.timeouts += 1
+        self.rto = min(self.rto * 2, self.ceiling)
+
+    def status(self):
+        return {"srtt_ms": round(self.srtt * 1000, 1) if self.srtt is not None else None,
+                "rttvar_ms": round(self.rttvar * 1000, 1) if self.rttvar is not None else None,
+                "timeout_ms": round(self.rto * 1000, 1), "samples": self.samples, "timeouts": self.timeouts}
+
+
+# Оценки всех устройств из config.json. Пределы таймаута задаются rtt_timeout_min_seconds и rtt_timeout_max_seconds,
+# для отдельного прибора - полями timeout_min и timeout_max в его описании; начальный таймаут - read_timeout
+device_rtts = {device: RttEstimator(device, d["read_timeout"],
+                                    device_config.get("timeout_min", d["rtt_timeout_min_seconds"]),
+                                    device_config.get("timeout_max", d["rtt_timeout_max_seconds"]))
+               for lab_num in d["labs"] for device, device_config in d[lab_num].items()}
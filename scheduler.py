@@ -1,8 +1,11 @@
 import json
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
 from lab13.lab13 import delete_logs as delete_logs_lab13
 from lab14.lab14 import delete_logs as delete_logs_lab14
-from poll_params import scheduled_task, delete_logs as delete_logs_poll
+from poll_params import scheduled_task, count_skipped_cycle, delete_logs as delete_logs_poll
+from modbus_pool import health_check_pools
+from history import drop_expired_history
 
 # Подгружаем настройки из файла
 with open('config.json') as f:
@@ -13,5 +16,10 @@ with open('config.json') as f:
 def configure_scheduler(scheduler):
     scheduler.add_job(delete_logs_lab13, 'interval', days=d["delete_logs_days"])
     scheduler.add_job(delete_logs_lab14, 'interval', days=d["delete_logs_days"])
-    scheduler.add_job(scheduled_task, 'interval', minutes=d["poll_time_minutes"], seconds=d["poll_time_seconds"])
+    scheduler.add_job(scheduled_task, 'interval', minutes=d["poll_time_minutes"], seconds=d["poll_time_seconds"],
+                      id="poll_params")
     scheduler.add_job(delete_logs_poll, 'interval', days=d["delete_logs_days"])
+    scheduler.add_job(health_check_pools, 'interval', seconds=d["pool_health_check_seconds"])
+    scheduler.add_job(drop_expired_history, 'interval', hours=1)
+    # Считаем запуски опроса, пропущенные из-за затянувшегося предыдущего цикла
+    scheduler.add_listener(count_skipped_cycle, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
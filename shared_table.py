@@ -0,0 +1,113 @@
+import math
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Таблица последних значений в разделяемой памяти (файл, отображенный в память каждого процесса).
+# Пишет только процесс опроса, остальные процессы читают значения без обращения к шлюзу и без системных вызовов.
+#
+# Заголовок: сигнатура, версия, контрольная сумма состава таблицы, pid процесса опроса.
+# Далее ячейки параметров (в порядке сортировки имен), затем ячейки устройств.
+# Ячейка: счетчик версии, значение, время (секунды Unix, 0 - значения нет). Для устройств значение - 1.0 или 0.0.
+# Запись идет по схеме seqlock: нечетный счетчик означает, что ячейка меняется, читатель повторяет чтение
+HEADER = struct.Struct("<4sIIq")
+HEADER_SIZE = 32
+SLOT = struct.Struct("<Qdd")
+SEQ = struct.Struct("<Q")
+DATA = struct.Struct("<dd")
+MAGIC = b"MBST"
+VERSION = 1
+READ_RETRIES = 100
+
+
+class SharedTable:
+    def __init__(self, path, names, devices):
+        self.path = path
+        self.names = sorted(names)
+        self.devices = sorted(devices)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.device_index = {device: len(self.names) + i for i, device in enumerate(self.devices)}
+        self.layout = zlib.crc32("\n".join(self.names + ["--"] + self.devices).encode())
+        self.size = HEADER_SIZE + SLOT.size * (len(self.names) + len(self.devices))
+        self._map = None
+        self._lock = threading.Lock()
+
+    # Подключение процесса опроса: файл создается или приводится к составу таблицы из config.json.
+    # Значения, оставшиеся от прежнего процесса опроса, сохраняются, их возраст проверяет max_age
+    def create(self, pid):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            table = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        magic, version, layout, _ = HEADER.unpack_from(table, 0)
+        if (magic, version, layout) != (MAGIC, VERSION, self.layout):
+            table[:] = bytes(self.size)
+        HEADER.pack_into(table, 0, MAGIC, VERSION, self.layout, pid)
+        # Прежнее отображение (процесс читал таблицу до того, как стал владельцем) не закрывается:
+        # его могут читать другие потоки, память освободится вместе с последней ссылкой
+        self._map = table
+
+    # Подключение читающего процесса. ValueError - таблица еще не создана или составлена по другому config.json
+    def open(self):
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                raise ValueError("Размер таблицы не совпадает с config.json")
+            table = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        magic, version, layout, _ = HEADER.unpack_from(table, 0)
+        if (magic, version, layout) != (MAGIC, VERSION, self.layout):
+            table.close()
+            raise ValueError("Таблица составлена по другому config.json")
+        self._map = table
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    @property
+    def owner_pid(self):
+        return HEADER.unpack_from(self._map, 0)[3]
+
+    def _write(self, slot, value, timestamp):
+        offset = HEADER_SIZE + SLOT.size * slot
+        with self._lock:
+            seq = SEQ.unpack_from(self._map, offset)[0]
+            SEQ.pack_into(self._map, offset, seq + 1)
+            DATA.pack_into(self._map, offset + SEQ.size, value, timestamp)
+            SEQ.pack_into(self._map, offset, seq + 2)
+
+    # (значение, время) или None, если значения нет или ячейка все время менялась
+    def _read(self, slot):
+        offset = HEADER_SIZE + SLOT.size * slot
+        for _ in range(READ_RETRIES):
+            seq, value, timestamp = SLOT.unpack_from(self._map, offset)
+            if seq & 1:
+                continue
+            if SEQ.unpack_from(self._map, offset)[0] == seq:
+                return (value, timestamp) if timestamp else None
+        return None
+
+    def write_param(self, name, value, timestamp):
+        self._write(self.index[name], math.nan if value is None else value, timestamp)
+
+    def read_param(self, name):
+        sample = self._read(self.index[name])
+        if sample is not None and math.isnan(sample[0]):
+            return None, sample[1]
+        return sample
+
+    def write_device(self, device, available, timestamp):
+        self._write(self.device_index[device], 1.0 if available else 0.0, timestamp)
+
+    def read_device(self, device):
+        sample = self._read(self.device_index[device])
+        return (sample[0] == 1.0, sample[1]) if sample else None
@@ -0,0 +1,69 @@
+import json
+from flask import Blueprint
+from flask_restful import Api, Resource, abort, reqparse
+from device_profiles import device_params, device_labs, param_max_age
+from modbus_service import modbus_service
+from poll_params import read_params
+from value_cache import value_cache, format_timestamp
+
+snapshot = Blueprint('snapshot', __name__)
+api = Api(snapshot)
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+
+def _value(value, timestamp, cached):
+    return {"value": value, "ts": timestamp, "time": format_timestamp(timestamp), "cached": cached, "error": None}
+
+
+# Параметры снимка: перечисленные в params или все параметры лабораторной работы
+def snapshot_names(lab, params):
+    if not params:
+        return [name for name, spec in device_params.items() if device_labs[spec.device] == lab]
+    names = params.split(",")
+    unknown = [name for name in names if name not in device_params]
+    if unknown:
+        abort(404, message="Нет параметров {}".format(", ".join(unknown)))
+    return names
+
+
+# Значения снимка: свежие берем из кэша опроса, остальные читаем с приборов одним обращением.
+# Выполняется в цикле событий modbus_service
+async def snapshot_values(lab, names, max_age):
+    values = {}
+    to_read = []
+    for name in names:
+        sample = value_cache.get(name, param_max_age(name, max_age))
+        if sample:
+            values[name] = _value(sample.value, sample.timestamp, True)
+        else:
+            to_read.append(device_params[name])
+    if to_read:
+        try:
+            answer, errors = await read_params(to_read)
+        except Exception as e:
+            answer, errors = [], {spec.name: f"Ошибка Modbus: {str(e)}" for spec in to_read}
+        for name, value, timestamp in answer:
+            value_cache.update(name, value, timestamp)
+            values[name] = _value(value, timestamp, False)
+        for spec in to_read:
+            if spec.name not in values:
+                values[spec.name] = {"value": None, "ts": None, "time": None, "cached": False,
+                                     "error": errors.get(spec.name, "Не удалось получить данные")}
+    return {"lab": lab, "values": {name: values[name] for name in names}}
+
+
+# Все значения лабораторной работы одним запросом: GET /<lab>/snapshot?params=T,P&max_age=n
+class SnapshotAPI(Resource):
+    def get(self, lab):
+        parser = reqparse.RequestParser(bundle_errors=True)
+        parser.add_argument("params", type=str, location="args")
+        parser.add_argument("max_age", type=float, location="args")
+        query = parser.parse_args()
+        names = snapshot_names(lab, query["params"])
+        return modbus_service.run(snapshot_values(lab, names, query["max_age"]))
+
+
+api.add_resource(SnapshotAPI, '/<any({}):lab>/snapshot'.format(", ".join(d["labs"])))
@@ -0,0 +1,110 @@
+import json
+import threading
+from collections import deque
+from flask import Blueprint, Response, request, stream_with_context
+from device_profiles import device_params
+
+stream = Blueprint('stream', __name__)
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+
+# Подписчик потока: ограниченная очередь значений одного клиента.
+# Если клиент не успевает читать, очередь сворачивается до последнего значения
+# каждого параметра, а если и этого мало - старые значения вытесняются новыми
+class Subscriber:
+    def __init__(self, params, queue_size):
+        self.params = params
+        self.dropped = 0
+        self._queue = deque(maxlen=queue_size)
+        self._ready = threading.Condition()
+
+    def push(self, samples):
+        with self._ready:
+            for sample in samples:
+                if len(self._queue) == self._queue.maxlen:
+                    self._conflate()
+                    if len(self._queue) == self._queue.maxlen:
+                        self.dropped += 1
+                self._queue.append(sample)
+            self._ready.notify()
+
+    def _conflate(self):
+        latest = {}
+        for sample in self._queue:
+            latest[sample[0]] = sample
+        self.dropped += len(self._queue) - len(latest)
+        self._queue.clear()
+        self._queue.extend(latest.values())
+
+    # Ожидание новых значений не дольше timeout секунд, возвращает все накопленные
+    def take(self, timeout):
+        with self._ready:
+            if not self._queue:
+                self._ready.wait(timeout)
+            samples = list(self._queue)
+            self._queue.clear()
+        return samples
+
+
+# Раздача значений одного источника (цикла опроса) любому числу подписчиков
+class Broadcaster:
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, params, queue_size):
+        subscriber = Subscriber(params, queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    # Публикация значений цикла опроса: [(param_name, value, timestamp)]
+    def publish(self, samples):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            selected = [sample for sample in samples if sample[0] in subscriber.params]
+            if selected:
+                subscriber.push(selected)
+
+
+broadcaster = Broadcaster()
+
+
+# Поток значений в формате Server-Sent Events: GET /stream?params=T,P
+@stream.route('/stream')
+def stream_values():
+    params = request.args.get("params")
+    params = set(params.split(",")) if params else set(device_params)
+    unknown = params - set(device_params)
+    if unknown:
+        return {"message": f"Нет параметров {', '.join(sorted(unknown))}"}, 404
+    subscriber = broadcaster.subscribe(params, d["stream_queue_size"])
+
+    def events():
+        try:
+            while True:
+                samples = subscriber.take(d["stream_keepalive_seconds"])
+                if not samples:
+                    # Комментарий SSE не дает прокси закрыть простаивающее соединение
+                    yield ": keepalive\n\n"
+                    continue
+                for param_name, value, timestamp in samples:
+                    data = json.dumps({"param": param_name, "value": value, "ts": timestamp})
+                    yield f"event: sample\ndata: {data}\n\n"
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
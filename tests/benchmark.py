@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Нагрузочная проверка сервиса без оборудования: имитатор шлюза tests/tcp_simulator.py, сервис
+# во временном каталоге со своим config.json (базы данных и журналы не попадают в репозиторий).
+# Измеряются длительность цикла опроса, задержки REST (p50/p99) и число запросов в секунду.
+#
+# Запуск из корня репозитория: python tests/benchmark.py --clients 8 --requests 400 --latency 5 --jitter 2
+# Режим ASGI (нужен uvicorn): python tests/benchmark.py --server asgi
+# Масштабирование опроса: python tests/benchmark.py --benches 50 --gateways 10 (копии lab14 за отдельными шлюзами)
+# Запись обмена во время проверки: --capture traffic.bin; проверка на записанном обмене вместо имитатора
+# (в том числе на журнале, снятом на установке через POST /traffic): --replay traffic.bin --replay-speed 10
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from tcp_simulator import Simulator  # noqa: E402
+
+# Запросы REST для измерения: чтение с прибора, чтение из кэша и все значения работы
+ENDPOINTS = {
+    "device_read": "/lab13/trm202/get_temp?max_age=0",
+    "cached_read": "/lab13/trm202/get_temp?max_age=60",
+    "snapshot": "/lab14/snapshot?max_age=0"
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)] if ordered else None
+
+
+def summary(durations):
+    return {"count": len(durations),
+            "p50_ms": round(percentile(durations, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(durations, 0.99) * 1000, 2),
+            "max_ms": round(max(durations) * 1000, 2)}
+
+
+# Имитатор шлюза в отдельном потоке со своим циклом событий
+def start_simulator(config, latency, jitter, dropout):
+    simulator = Simulator(config, latency, jitter, dropout)
+    loop = asyncio.new_event_loop()
+    port = free_port()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(simulator.start("127.0.0.1", port))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="simulator", daemon=True).start()
+    started.wait()
+    return simulator, port
+
+
+# Дополнительные установки для проверки масштабирования опроса: копии lab14 (lab100, lab101, ...)
+# за шлюзами gw0..gw{n-1}. Номера приборов (slave_id) назначаются заново в пределах каждого шлюза
+def add_benches(config, benches, gateways):
+    template = config["lab14"]
+    config = dict(config, labs=list(config["labs"]), gateways=dict(config.get("gateways", {})),
+                  lab_gateways=dict(config.get("lab_gateways", {})))
+    slave_ids = {}
+    for i in range(benches):
+        lab_num = f"lab{100 + i}"
+        gateway = f"gw{i % gateways}"
+        bench = {}
+        for device, device_config in template.items():
+            slave_id = slave_ids[gateway] = slave_ids.get(gateway, 0) + 1
+            if slave_id > 247:
+                sys.exit("Слишком много приборов на один шлюз, увеличьте --gateways")
+            params = {f"{name}_{i}": param for name, param in device_config.get("params", {}).items()}
+            bench[f"{device}_{i}"] = dict(device_config, slave_id=slave_id, params=params)
+        config[lab_num] = bench
+        config["labs"].append(lab_num)
+        config["lab_gateways"][lab_num] = gateway
+    return config
+
+
+# Имитаторы шлюзов добавленных установок: у каждого шлюза свой имитатор со своими приборами
+def start_gateway_simulators(config, latency, jitter, dropout):
+    simulators = []
+    for gateway in sorted(set(config["lab_gateways"].values())):
+        labs = [lab_num for lab_num, name in config["lab_gateways"].items() if name == gateway]
+        simulator, port = start_simulator(dict(config, labs=labs), latency, jitter, dropout)
+        config["gateways"][gateway] = {"host": "127.0.0.1", "port": port}
+        simulators.append(simulator)
+    return simulators
+
+
+# Рабочий каталог сервиса: config.json из репозитория, направленный на имитатор
+def prepare_workdir(config, port):
+    workdir = tempfile.mkdtemp(prefix="modbus_bench_")
+    config = dict(config, server_host="127.0.0.1", server_port=port)
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return workdir
+
+
+# Полные циклы опроса: перед каждым все параметры считаются подошедшими к опросу
+def bench_poll(cycles):
+    from modbus_service import modbus_service
+    from poll_params import scheduled_task, poll_stats, gateway_poll_stats
+    from poll_schedule import poll_schedule
+
+    durations = []
+    for _ in range(cycles):
+        poll_schedule.reset()
+        started = time.perf_counter()
+        modbus_service.run(scheduled_task())
+        durations.append(time.perf_counter() - started)
+    result = summary(durations)
+    result["overruns"] = poll_stats["overruns"]
+    result["gateways"] = len(gateway_poll_stats)
+    result["devices"] = sum(stats["devices"] for stats in gateway_poll_stats.values())
+    return result
+
+
+# Сервер WSGI (werkzeug, поток на запрос) поверх собственного потока сервиса Modbus
+def start_wsgi_server(port):
+    from werkzeug.serving import make_server
+    from app import app
+    from modbus_service import modbus_service
+
+    modbus_service.start()
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="http", daemon=True).start()
+
+    def stop():
+        server.shutdown()
+        modbus_service.stop()
+    return stop
+
+
+# Сервер ASGI (uvicorn): сервис Modbus работает в цикле событий сервера, как при запуске asgi.py.
+# Планировщик опроса не запускается, как и в режиме WSGI
+def start_asgi_server(port):
+    import uvicorn
+    from asgi import application
+    from modbus_service import modbus_service
+
+    server = uvicorn.Server(uvicorn.Config(application, host="127.0.0.1", port=port, lifespan="off",
+                                           log_level="warning"))
+    loop = asyncio.new_event_loop()
+    modbus_service.attach(loop)
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.serve())
+        loop.run_until_complete(modbus_service.detach())
+        loop.close()
+
+    thread = threading.Thread(target=run, name="http", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return stop
+
+
+def bench_rest(base_url, path, clients, total):
+    session_local = threading.local()
+
+    def one_request(_):
+        session = getattr(session_local, "session", None)
+        if session is None:
+            session = session_local.session = requests.Session()
+        started = time.perf_counter()
+        response = session.get(base_url + path)
+        return time.perf_counter() - started, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        results = list(executor.map(one_request, range(total)))
+    elapsed = time.perf_counter() - started
+    result = summary([duration for duration, _ in results])
+    result["errors"] = sum(1 for _, status in results if status != 200)
+    result["rps"] = round(total / elapsed, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка сервиса на имитаторе шлюза")
+    parser.add_argument("--cycles", type=int, default=30, help="число циклов опроса")
+    parser.add_argument("--clients", type=int, default=8, help="одновременные клиенты REST")
+    parser.add_argument("--requests", type=int, default=400, help="запросов REST на каждую ручку")
+    parser.add_argument("--latency", type=float, default=5, help="задержка ответа имитатора, мс")
+    parser.add_argument("--jitter", type=float, default=2, help="разброс задержки имитатора, мс")
+    parser.add_argument("--dropout", type=float, default=0, help="доля запросов без ответа, 0..1")
+    parser.add_argument("--benches", type=int, default=0, help="дополнительные установки (копии lab14)")
+    parser.add_argument("--gateways", type=int, default=1, help="шлюзы дополнительных установок")
+    parser.add_argument("--server", choices=("wsgi", "asgi"), default="wsgi", help="сервер HTTP")
+    parser.add_argument("--output", help="файл JSON для сохранения результатов")
+    parser.add_argument("--capture", help="записать обмен с имитатором в журнал")
+    parser.add_argument("--replay", help="воспроизводить журнал обмена вместо имитатора")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="ускорение воспроизведения")
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, "config.json")) as f:
+        config = json.load(f)
+    simulators = []
+    if args.replay:
+        port = config["server_port"]
+        if args.benches:
+            config = add_benches(config, args.benches, args.gateways)
+        config = dict(config, replay_file=os.path.abspath(args.replay), replay_speed=args.replay_speed)
+    else:
+        simulator, port = start_simulator(config, args.latency / 1000, args.jitter / 1000, args.dropout)
+        simulators.append(simulator)
+        if args.benches:
+            config = add_benches(config, args.benches, args.gateways)
+            simulators += start_gateway_simulators(config, args.latency / 1000, args.jitter / 1000, args.dropout)
+    capture_path = os.path.abspath(args.capture) if args.capture else None
+    workdir = prepare_workdir(config, port)
+    os.chdir(workdir)
+    try:
+        # Сервер запускается до измерения опроса: в режиме ASGI цикл событий сервиса принадлежит серверу
+        http_port = free_port()
+        start_server = start_asgi_server if args.server == "asgi" else start_wsgi_server
+        stop_server = start_server(http_port)
+        from traffic_capture import traffic_capture, replay_source
+        if capture_path:
+            traffic_capture.start(capture_path)
+        results = {"settings": vars(args), "poll_cycle": bench_poll(args.cycles)}
+
+        base_url = f"http://127.0.0.1:{http_port}"
+        results["rest"] = {name: bench_rest(base_url, path, args.clients, args.requests)
+                           for name, path in ENDPOINTS.items()}
+        stop_server()
+        if capture_path:
+            traffic_capture.stop()
+            results["capture"] = traffic_capture.status()
+            del results["capture"]["files"]
+        if replay_source:
+            results["replay"] = replay_source.stats
+        if simulators:
+            results["simulator"] = {name: sum(item.stats[name] for item in simulators) for name in simulators[0].stats}
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+from device_profiles import device_params  # noqa: E402
+from modbus_rtu import RtuBus, bus_stats  # noqa: E402
+from read_plan import compile_plan, plan_by_device, execute_request, slice_registers  # noqa: E402
+from rtt_estimator import device_rtts  # noqa: E402
+from rtu_simulator import RtuSimulator  # noqa: E402
+
+# Проверка обмена Modbus RTU без оборудования: имитатор приборов config.json на одном конце пары pty,
+# шина modbus_rtu.RtuBus на другом. Все приборы опрашиваются одновременно, как в цикле опроса,
+# выводятся прочитанные значения, длительность циклов и статистика шины.
+# Каждый прибор за цикл читают --repeat независимых клиентов (опрос, запросы REST, снимки), поэтому к одному
+# прибору в очереди бывает несколько запросов. С --fifo запросы уходят строго по очереди (для сравнения).
+# Таймауты запросов - как у опроса, по оценке времени ответа приборов (--timeout задает постоянный). Ожидание
+# в очереди шины не должно приводить к таймаутам: таймауты оценок выводятся вместе с таймаутами шины.
+#
+# Запуск из корня репозитория: python tests/rtu_check.py --baudrate 19200 --latency 5 --turnaround 10
+
+
+# Шина без перестановки запросов: следующий запрос всегда первый в очереди
+class FifoBus(RtuBus):
+    def _select(self, now):
+        transaction, wait_until = super()._select(now)
+        head = min(self._pending, key=lambda item: (item.priority, item.order), default=None)
+        if transaction is not None and transaction is not head:
+            self.stats["reordered"] -= 1
+            return None, self._ready_time(head)
+        return transaction, wait_until
+
+
+async def read_device(bus, requests, values, errors, timeout):
+    async with bus.connection() as client:
+        for request in requests:
+            try:
+                response = await execute_request(client, request, timeout)
+            except Exception as e:
+                errors.append(f"{request.slave_id}: {type(e).__name__} {e}")
+                continue
+            if response.isError():
+                errors.append(f"{request.slave_id}: {response}")
+                continue
+            for spec, registers in slice_registers(request, response.registers):
+                values[spec.name] = spec.decode(registers)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Проверка шины Modbus RTU на имитаторе через pty")
+    parser.add_argument("--cycles", type=int, default=20)
+    parser.add_argument("--baudrate", type=int, default=19200)
+    parser.add_argument("--latency", type=float, default=5, help="время обработки запроса прибором, мс")
+    parser.add_argument("--turnaround", type=float, default=10, help="пауза прибора после ответа, мс")
+    parser.add_argument("--repeat", type=int, default=3, help="одновременные клиенты каждого прибора")
+    parser.add_argument("--fifo", action="store_true", help="отправлять запросы без перестановки")
+    parser.add_argument("--timeout", type=float, help="постоянный таймаут запроса, с (по умолчанию - по оценке)")
+    args = parser.parse_args()
+    with open("config.json") as f:
+        config = json.load(f)
+
+    simulator = RtuSimulator(config, None, args.baudrate, args.latency / 1000, args.turnaround / 1000)
+    path = simulator.open()
+    bus = (FifoBus if args.fifo else RtuBus)("check", path, baudrate=args.baudrate, turnaround=args.turnaround / 1000,
+                                             response_timeout=0.3)
+    plan = plan_by_device(compile_plan(device_params.values()))
+    durations = []
+    values = {}
+    errors = []
+    try:
+        for _ in range(args.cycles):
+            started = time.monotonic()
+            await asyncio.gather(*(read_device(bus, requests, values, errors, args.timeout)
+                                   for requests in plan.values() for _ in range(args.repeat)))
+            durations.append(time.monotonic() - started)
+        utilization = bus.utilization()
+    finally:
+        bus.close()
+        simulator.close()
+
+    print(f"Порт {path}, {args.baudrate} бод, приборов {len(plan)}, запросов за цикл "
+          f"{args.repeat * sum(len(requests) for requests in plan.values())}, {'FIFO' if args.fifo else 'планировщик'}")
+    print("Значения:", ", ".join(f"{name}={value}" for name, value in sorted(values.items())))
+    print(f"Цикл опроса: среднее {1000 * sum(durations) / len(durations):.1f} мс, "
+          f"наибольшее {1000 * max(durations):.1f} мс")
+    stats = dict(bus_stats()["check"], utilization=utilization)
+    del stats["queued"], stats["connected"]
+    print("Шина:", ", ".join(f"{name}={value}" for name, value in stats.items()))
+    print("Имитатор:", ", ".join(f"{name}={value}" for name, value in simulator.stats.items()))
+    print("Оценки:", ", ".join(f"{device} srtt={rtt.status()['srtt_ms']} мс timeout={rtt.status()['timeout_ms']} мс "
+                               f"timeouts={rtt.timeouts}" for device, rtt in device_rtts.items() if device in plan))
+    if errors:
+        print(f"Ошибки ({len(errors)}):", "; ".join(errors[:5]))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
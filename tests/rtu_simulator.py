@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from modbus_rtu import crc16  # noqa: E402
+from tcp_simulator import Simulator, READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS, WRITE_SINGLE_REGISTER, \
+    WRITE_MULTIPLE_REGISTERS  # noqa: E402
+
+# Имитатор приборов на шине Modbus RTU без оборудования: псевдотерминал (pty) вместо порта RS-485.
+# Приборы и значения параметров - как у tcp_simulator. Время передачи кадров по линии имитируется по скорости
+# baudrate, прибор отвечает с задержкой latency и не принимает запросы turnaround секунд после своего ответа.
+#
+# Запуск: python tests/rtu_simulator.py --gateway bus1 --baudrate 19200 --latency 5 --turnaround 10 --link /tmp/ttyRTU
+# (в config.json сервиса шлюз "bus1": {"transport": "rtu", "serial_port": "/tmp/ttyRTU", "baudrate": 19200, ...})
+
+
+# Приборы, подключенные к шлюзу gateway (None - все приборы config.json)
+def gateway_devices(config, gateway):
+    lab_gateways = config.get("lab_gateways", {})
+    return {device for lab_num in config["labs"] for device, device_config in config[lab_num].items()
+            if gateway is None or device_config.get("gateway", lab_gateways.get(lab_num)) == gateway}
+
+
+# Длина кадра запроса по началу кадра или None, если начала еще не хватает
+def request_size(buffer):
+    if len(buffer) < 2:
+        return None
+    if buffer[1] in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS, WRITE_SINGLE_REGISTER):
+        return 8
+    if buffer[1] == WRITE_MULTIPLE_REGISTERS:
+        return 9 + buffer[6] if len(buffer) >= 7 else None
+    return len(buffer)
+
+
+class RtuSimulator:
+    def __init__(self, config, gateway=None, baudrate=9600, latency=0.0, turnaround=0.0, dropout=0.0):
+        self.simulator = Simulator(config)
+        devices = gateway_devices(config, gateway)
+        self.simulator.slaves = {unit_id: slave for unit_id, slave in self.simulator.slaves.items()
+                                 if slave.name in devices}
+        self.char_time = 11 / baudrate
+        self.latency = latency
+        self.turnaround = turnaround
+        self.dropout = dropout
+        self.stats = {"requests": 0, "ignored": 0, "dropped": 0, "crc_errors": 0}
+        self.master = None
+        self.slave = None
+        self._buffer = bytearray()
+        self._ready_at = {}
+        self._line = None
+
+    # Открытие пары pty: сервис работает с концом, путь к которому возвращается (или ссылкой link на него)
+    def open(self, link=None):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        path = os.ttyname(self.slave)
+        if link:
+            if os.path.lexists(link):
+                os.unlink(link)
+            os.symlink(path, link)
+            path = link
+        self._line = asyncio.Lock()
+        asyncio.get_running_loop().add_reader(self.master, self._on_readable)
+        return path
+
+    def close(self):
+        if self.master is not None:
+            asyncio.get_running_loop().remove_reader(self.master)
+            os.close(self.master)
+            os.close(self.slave)
+            self.master = None
+
+    def _on_readable(self):
+        self._buffer += os.read(self.master, 1024)
+        while True:
+            size = request_size(self._buffer)
+            if size is None or len(self._buffer) < size:
+                return
+            frame = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            if crc16(frame[:-2]) != frame[-2:]:
+                self.stats["crc_errors"] += 1
+                self._buffer.clear()
+                return
+            asyncio.ensure_future(self._respond(frame, asyncio.get_running_loop().time()))
+
+    async def _respond(self, frame, received):
+        unit_id = frame[0]
+        self.stats["requests"] += 1
+        if unit_id == 0:
+            for slave_id in self.simulator.slaves:
+                self.simulator._handle(slave_id, frame[1:-2])
+            return
+        if unit_id not in self.simulator.slaves:
+            return
+        # Прибор, еще не готовый после прошлого ответа, запрос не замечает
+        if received < self._ready_at.get(unit_id, 0.0):
+            self.stats["ignored"] += 1
+            return
+        if random.random() < self.dropout:
+            self.stats["dropped"] += 1
+            return
+        response = bytes([unit_id]) + self.simulator._handle(unit_id, frame[1:-2])
+        response += crc16(response)
+        # Передача запроса по линии, обработка в приборе и передача ответа
+        await asyncio.sleep(len(frame) * self.char_time + self.latency + len(response) * self.char_time)
+        async with self._line:
+            os.write(self.master, response)
+        self._ready_at[unit_id] = asyncio.get_running_loop().time() + self.turnaround
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Имитатор приборов на шине Modbus RTU (pty) по config.json")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--gateway", help="шлюз RTU из config.json, приборы которого имитируются (по умолчанию все)")
+    parser.add_argument("--baudrate", type=int, default=9600)
+    parser.add_argument("--latency", type=float, default=0, help="время обработки запроса прибором, мс")
+    parser.add_argument("--turnaround", type=float, default=0, help="пауза прибора после ответа, мс")
+    parser.add_argument("--dropout", type=float, default=0, help="доля запросов без ответа, 0..1")
+    parser.add_argument("--link", help="символическая ссылка на порт для config.json")
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = json.load(f)
+    simulator = RtuSimulator(config, args.gateway, args.baudrate, args.latency / 1000, args.turnaround / 1000,
+                             args.dropout)
+    path = simulator.open(args.link)
+    print(f"Имитатор шины RTU на порту {path}, приборы: "
+          f"{', '.join(f'{slave.name} ({unit_id})' for unit_id, slave in simulator.simulator.slaves.items())}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        simulator.close()
+        if args.link:
+            os.unlink(args.link)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import struct
+import time
+
+# Локальный имитатор шлюза Modbus TCP: отвечает за все приборы из config.json (ТРМ202, ТРМ200, ТРМ210,
+# датчик давления, датчик перепада давления). Значения параметров меняются во времени, задержка ответа,
+# ее разброс и доля потерянных запросов настраиваются.
+#
+# Запуск: python tests/tcp_simulator.py --port 5020 --latency 5 --jitter 2 --dropout 0.01
+# (в config.json сервиса указать "server_host": "127.0.0.1", "server_port": 5020)
+
+# Формат struct и число регистров типов данных, как в device_profiles
+DATA_TYPES = {
+    "uint16": ("H", 1),
+    "int16": ("h", 1),
+    "uint32": ("I", 2),
+    "int32": ("i", 2),
+    "float32": ("f", 2),
+    "float64": ("d", 4)
+}
+
+# Изменение параметров: среднее, амплитуда колебаний и период в секундах
+MODELS = {
+    "P": (1200.0, 300.0, 20.0),
+    "T": (25.0, 2.0, 120.0),
+    "T1": (30.0, 3.0, 180.0),
+    "T2": (28.0, 2.0, 150.0),
+    "p": (101.3, 5.0, 30.0),
+    "DP": (40.0, 20.0, 10.0)
+}
+DEFAULT_MODEL = (100.0, 10.0, 60.0)
+
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+WRITE_SINGLE_REGISTER = 6
+WRITE_MULTIPLE_REGISTERS = 16
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+GATEWAY_TARGET_FAILED = 11
+
+
+# Параметр, значение которого имитатор пересчитывает при каждом чтении
+class SimulatedParam:
+    def __init__(self, name, function_code, address, data_type, word_order, scale, offset):
+        self.name = name
+        self.function_code = function_code
+        self.address = address
+        fmt, self.count = DATA_TYPES[data_type]
+        self.integer = fmt not in ("f", "d")
+        self._pack = struct.Struct(f">{fmt}").pack
+        self._unpack_words = struct.Struct(f">{self.count}H").unpack
+        self.swap_words = word_order == "little" and self.count > 1
+        self.scale = scale
+        self.offset = offset
+        self.mean, self.amplitude, self.period = MODELS.get(name, DEFAULT_MODEL)
+
+    def value(self, now):
+        return self.mean + self.amplitude * math.sin(2 * math.pi * now / self.period) + random.gauss(0, self.amplitude / 50)
+
+    # Значение в регистрах прибора: обратное преобразование к декодеру device_profiles
+    def registers(self, now):
+        raw = (self.value(now) - self.offset) / self.scale
+        words = self._unpack_words(self._pack(round(raw) if self.integer else raw))
+        return list(reversed(words)) if self.swap_words else list(words)
+
+
+# Один прибор: регистры хранения и входные регистры, параметры из config.json поверх них
+class SimulatedSlave:
+    def __init__(self, name):
+        self.name = name
+        self.registers = {READ_HOLDING_REGISTERS: {}, READ_INPUT_REGISTERS: {}}
+        self.params = []
+
+    def read(self, function_code, address, count, now):
+        table = dict(self.registers[function_code])
+        for param in self.params:
+            if param.function_code == function_code and param.address < address + count \
+                    and param.address + param.count > address:
+                for i, word in enumerate(param.registers(now)):
+                    table[param.address + i] = word
+        return [table.get(address + i, 0) for i in range(count)]
+
+    def write(self, address, values):
+        for i, value in enumerate(values):
+            self.registers[READ_HOLDING_REGISTERS][address + i] = value
+
+
+def build_slaves(config):
+    profiles = config.get("profiles", {})
+    slaves = {}
+    for lab_num in config["labs"]:
+        for device, device_config in config[lab_num].items():
+            slave = slaves.setdefault(device_config["slave_id"], SimulatedSlave(device))
+            profile = profiles.get(device_config.get("profile"), {})
+            for param_name, param_config in device_config.get("params", {}).items():
+                options = dict(profile, **param_config)
+                slave.params.append(SimulatedParam(param_name, options.get("function_code", READ_HOLDING_REGISTERS),
+                                                   options["register"], options.get("data_type", "uint16"),
+                                                   options.get("word_order", "big"), options.get("scale", 1),
+                                                   options.get("offset", 0)))
+    return slaves
+
+
+# Сервер Modbus TCP на asyncio. latency и jitter - в секундах, dropout - доля запросов, оставленных без ответа,
+# device_latency - задержка отдельных приборов вместо latency: {имя прибора: секунды}
+class Simulator:
+    def __init__(self, config, latency=0.0, jitter=0.0, dropout=0.0, device_latency=None):
+        self.slaves = build_slaves(config)
+        self.latency = latency
+        self.unit_latency = {unit_id: (device_latency or {}).get(slave.name, latency)
+                             for unit_id, slave in self.slaves.items()}
+        self.jitter = jitter
+        self.dropout = dropout
+        self.stats = {"requests": 0, "dropped": 0, "errors": 0}
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=5020):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _serve(self, reader, writer):
+        # Шлюз обрабатывает запросы одного соединения по очереди, как последовательная шина за ним
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction_id, protocol_id, length, unit_id = struct.unpack(">HHHB", header)
+                pdu = await reader.readexactly(length - 1)
+                self.stats["requests"] += 1
+                delay = self.unit_latency.get(unit_id, self.latency) + random.uniform(-self.jitter, self.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if random.random() < self.dropout:
+                    self.stats["dropped"] += 1
+                    continue
+                response = self._handle(unit_id, pdu)
+                writer.write(struct.pack(">HHHB", transaction_id, protocol_id, len(response) + 1, unit_id) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _handle(self, unit_id, pdu):
+        function_code = pdu[0]
+        slave = self.slaves.get(unit_id)
+        if slave is None:
+            return self._error(function_code, GATEWAY_TARGET_FAILED)
+        if function_code in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+            address, count = struct.unpack(">HH", pdu[1:5])
+            if not 1 <= count <= 125:
+                return self._error(function_code, ILLEGAL_ADDRESS)
+            values = slave.read(function_code, address, count, time.time())
+            return struct.pack(f">BB{count}H", function_code, 2 * count, *values)
+        if function_code == WRITE_SINGLE_REGISTER:
+            address, value = struct.unpack(">HH", pdu[1:5])
+            slave.write(address, [value])
+            return pdu[:5]
+        if function_code == WRITE_MULTIPLE_REGISTERS:
+            address, count, _ = struct.unpack(">HHB", pdu[1:6])
+            slave.write(address, struct.unpack(f">{count}H", pdu[6:6 + 2 * count]))
+            return pdu[:5]
+        return self._error(function_code, ILLEGAL_FUNCTION)
+
+    def _error(self, function_code, code):
+        self.stats["errors"] += 1
+        return struct.pack(">BB", function_code | 0x80, code)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Имитатор шлюза Modbus TCP по config.json")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5020)
+    parser.add_argument("--latency", type=float, default=0, help="задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=0, help="разброс задержки, мс")
+    parser.add_argument("--dropout", type=float, default=0, help="доля запросов без ответа, 0..1")
+    parser.add_argument("--device-latency", action="append", default=[], metavar="ПРИБОР=МС",
+                        help="задержка отдельного прибора, например trm210=150")
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = json.load(f)
+    device_latency = {name: float(ms) / 1000 for name, ms in (item.split("=") for item in args.device_latency)}
+    simulator = Simulator(config, args.latency / 1000, args.jitter / 1000, args.dropout, device_latency)
+    port = await simulator.start(args.host, args.port)
+    print(f"Имитатор шлюза запущен на {args.host}:{port}, приборы: "
+          f"{', '.join(f'{slave.name} ({unit_id})' for unit_id, slave in simulator.slaves.items())}")
+    async with simulator.server:
+        await simulator.server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,331 @@
+import asyncio
+import json
+import os
+import queue
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+from flask import Blueprint, send_from_directory
+from flask_restful import Api, Resource, abort, reqparse
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.register_read_message import ReadHoldingRegistersResponse, ReadInputRegistersResponse
+from pymodbus.register_write_message import WriteMultipleRegistersResponse
+
+traffic = Blueprint('traffic', __name__)
+api = Api(traffic)
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+# Запись обмена Modbus в двоичный журнал и его воспроизведение.
+#
+# Файл: заголовок FILE_HEADER (сигнатура, версия, время начала записи в секундах Unix), затем записи.
+# Запись начинается с RECORD: вид, время от начала записи, длительность запроса (секунды), номер шлюза, slave,
+# итог, длины PDU запроса и ответа; за ним PDU запроса и PDU ответа. Запись вида KIND_GATEWAY объявляет номер шлюза:
+# ее PDU запроса - имя шлюза в UTF-8. Все числа little-endian, PDU - как в кадре Modbus (big-endian)
+MAGIC = b"MBTR"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sHd")
+RECORD = struct.Struct("<BdfBBBBB")
+
+KIND_GATEWAY = 0
+KIND_REQUEST = 1
+
+STATUS_OK = 0       # получен ответ (в том числе с кодом ошибки прибора)
+STATUS_TIMEOUT = 1  # ответа нет: запрос прерван по таймауту
+STATUS_ERROR = 2    # ошибка обмена (разрыв соединения, неверный ответ)
+
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+WRITE_MULTIPLE_REGISTERS = 16
+
+# Код ошибки "прибор за шлюзом не ответил": ответ воспроизведения на запрос, которого нет в записи
+GATEWAY_TARGET_FAILED = 11
+
+# Запрос из журнала обмена
+Exchange = namedtuple("Exchange", ["gateway", "offset", "duration", "slave", "status", "request", "response"])
+
+
+def _request_pdu(function_code, address, count=None, values=None):
+    if values is None:
+        return struct.pack(">BHH", function_code, address, count)
+    return struct.pack(f">BHHB{len(values)}H", function_code, address, len(values), 2 * len(values), *values)
+
+
+def _response_pdu(function_code, response):
+    if response.isError():
+        return struct.pack(">BB", function_code | 0x80, getattr(response, "exception_code", 0))
+    if function_code == WRITE_MULTIPLE_REGISTERS:
+        return struct.pack(">BHH", function_code, response.address, response.count)
+    registers = response.registers
+    return struct.pack(f">BB{len(registers)}H", function_code, 2 * len(registers), *registers)
+
+
+# Ответ в виде объекта pymodbus по PDU из журнала
+def _decode_response(pdu):
+    function_code = pdu[0]
+    if function_code & 0x80:
+        return ExceptionResponse(function_code & 0x7F, pdu[1])
+    if function_code == WRITE_MULTIPLE_REGISTERS:
+        return WriteMultipleRegistersResponse(*struct.unpack(">HH", pdu[1:5]))
+    registers = list(struct.unpack(f">{pdu[1] // 2}H", pdu[2:2 + pdu[1]]))
+    if function_code == READ_INPUT_REGISTERS:
+        return ReadInputRegistersResponse(registers)
+    return ReadHoldingRegistersResponse(registers)
+
+
+# Чтение журнала: заголовок (время начала) и список запросов
+def read_capture(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, started = FILE_HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} - не журнал обмена Modbus")
+    gateways = {}
+    exchanges = []
+    position = FILE_HEADER.size
+    while position + RECORD.size <= len(data):
+        kind, offset, duration, gateway, slave, status, request_size, response_size = RECORD.unpack_from(data, position)
+        position += RECORD.size
+        request = data[position:position + request_size]
+        response = data[position + request_size:position + request_size + response_size]
+        position += request_size + response_size
+        if kind == KIND_GATEWAY:
+            gateways[gateway] = request.decode()
+        else:
+            exchanges.append(Exchange(gateways[gateway], offset, duration, slave, status, request, response))
+    return started, exchanges
+
+
+# Запись журнала. Запросы выполняются в цикле событий, а в файл их пишет фоновый поток,
+# поэтому запись не задерживает обмен с приборами
+class TrafficCapture:
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = None
+        self.records = 0
+        self.size = 0
+        self._queue = None
+        self._thread = None
+        self._started = 0.0
+        self._gateways = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self._queue is not None
+
+    def start(self, path=None, seconds=None):
+        with self._lock:
+            if self.active:
+                raise ValueError(f"Запись уже идет в {os.path.basename(self.path)}")
+            if path is None:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, datetime.now().strftime("traffic_%Y%m%d_%H%M%S.bin"))
+            self.path = path
+            self.records = 0
+            self.size = FILE_HEADER.size
+            self._gateways = {}
+            self._started = time.monotonic()
+            self._queue = queue.SimpleQueue()
+            self._thread = threading.Thread(target=self._write, args=(path, self._queue, time.time()), daemon=True)
+            self._thread.start()
+            if seconds:
+                self._timer = threading.Timer(seconds, self.stop)
+                self._timer.daemon = True
+                self._timer.start()
+        return self.path
+
+    def stop(self):
+        with self._lock:
+            if not self.active:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._queue.put(None)
+            self._queue = None
+        self._thread.join()
+        self._thread = None
+
+    @staticmethod
+    def _write(path, records, started):
+        with open(path, "wb") as f:
+            f.write(FILE_HEADER.pack(MAGIC, VERSION, started))
+            while True:
+                record = records.get()
+                if record is None:
+                    return
+                f.write(record)
+
+    def record(self, gateway, slave, started, status, request, response=b""):
+        records = self._queue
+        if records is None:
+            return
+        if gateway not in self._gateways:
+            if len(self._gateways) > 255:
+                return
+            self._gateways[gateway] = len(self._gateways)
+            name = gateway.encode()
+            record = RECORD.pack(KIND_GATEWAY, 0.0, 0.0, self._gateways[gateway], 0, 0, len(name), 0) + name
+            records.put(record)
+            self.size += len(record)
+        now = time.monotonic()
+        record = RECORD.pack(KIND_REQUEST, started - self._started, now - started, self._gateways[gateway], slave,
+                             status, len(request), len(response)) + request + response
+        records.put(record)
+        self.records += 1
+        self.size += len(record)
+
+    # Клиент соединения со шлюзом, запросы которого попадают в журнал, или сам клиент, если запись не идет
+    def wrap(self, client, gateway):
+        return CapturingClient(client, gateway, self) if self.active else client
+
+    def status(self):
+        return {"active": self.active, "file": os.path.basename(self.path) if self.path else None,
+                "records": self.records, "bytes": self.size,
+                "files": sorted(name for name in os.listdir(self.directory) if name.endswith(".bin"))
+                if os.path.isdir(self.directory) else []}
+
+
+# Клиент, записывающий запросы и ответы в журнал. Прерванный по таймауту запрос записывается без ответа
+class CapturingClient:
+    def __init__(self, client, gateway, capture):
+        self.client = client
+        self.gateway = gateway
+        self.capture = capture
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def _call(self, slave, function_code, request, call):
+        started = time.monotonic()
+        try:
+            response = await call
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            self.capture.record(self.gateway, slave, started, STATUS_TIMEOUT, request)
+            raise
+        except Exception:
+            self.capture.record(self.gateway, slave, started, STATUS_ERROR, request)
+            raise
+        self.capture.record(self.gateway, slave, started, STATUS_OK, request, _response_pdu(function_code, response))
+        return response
+
+    async def read_holding_registers(self, address, count=1, slave=1):
+        return await self._call(slave, READ_HOLDING_REGISTERS, _request_pdu(READ_HOLDING_REGISTERS, address, count),
+                                self.client.read_holding_registers(address=address, count=count, slave=slave))
+
+    async def read_input_registers(self, address, count=1, slave=1):
+        return await self._call(slave, READ_INPUT_REGISTERS, _request_pdu(READ_INPUT_REGISTERS, address, count),
+                                self.client.read_input_registers(address=address, count=count, slave=slave))
+
+    async def write_registers(self, address, values, slave=1):
+        request = _request_pdu(WRITE_MULTIPLE_REGISTERS, address, values=[int(value) for value in values])
+        return await self._call(slave, WRITE_MULTIPLE_REGISTERS, request,
+                                self.client.write_registers(address=address, values=values, slave=slave))
+
+
+# Источник ответов для воспроизведения: для каждого запроса (шлюз, slave, PDU запроса) ответы из журнала
+# выдаются по кругу в записанном порядке, с записанной длительностью, деленной на speed
+class ReplaySource:
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.started, exchanges = read_capture(path)
+        self._answers = {}
+        for exchange in exchanges:
+            self._answers.setdefault((exchange.gateway, exchange.slave, exchange.request), deque()).append(exchange)
+        self.stats = {"replayed": 0, "unknown": 0}
+
+    def client_factory(self, gateway):
+        return lambda: ReplayClient(self, gateway)
+
+    # Ответ на запрос: объект ответа pymodbus, asyncio.TimeoutError или ConnectionError, как при записи
+    async def answer(self, gateway, slave, function_code, request):
+        answers = self._answers.get((gateway, slave, request))
+        if not answers:
+            self.stats["unknown"] += 1
+            # Записи, которых нет в журнале, выполняются успешно, чтения - с ошибкой прибора
+            if function_code == WRITE_MULTIPLE_REGISTERS:
+                return _decode_response(request[:5])
+            return ExceptionResponse(function_code, GATEWAY_TARGET_FAILED)
+        exchange = answers[0]
+        answers.rotate(-1)
+        self.stats["replayed"] += 1
+        await asyncio.sleep(exchange.duration / self.speed)
+        if exchange.status == STATUS_TIMEOUT:
+            raise asyncio.TimeoutError()
+        if exchange.status == STATUS_ERROR:
+            raise ConnectionError(f"Ошибка обмена с прибором {slave} в журнале {os.path.basename(self.path)}")
+        return _decode_response(exchange.response)
+
+
+# Клиент воспроизведения с интерфейсом AsyncModbusTcpClient для пула соединений (modbus_pool.ConnectionPool)
+class ReplayClient:
+    def __init__(self, source, gateway):
+        self.source = source
+        self.gateway = gateway
+        self.connected = False
+
+    async def connect(self):
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+
+    async def read_holding_registers(self, address, count=1, slave=1):
+        return await self.source.answer(self.gateway, slave, READ_HOLDING_REGISTERS,
+                                        _request_pdu(READ_HOLDING_REGISTERS, address, count))
+
+    async def read_input_registers(self, address, count=1, slave=1):
+        return await self.source.answer(self.gateway, slave, READ_INPUT_REGISTERS,
+                                        _request_pdu(READ_INPUT_REGISTERS, address, count))
+
+    async def write_registers(self, address, values, slave=1):
+        return await self.source.answer(self.gateway, slave, WRITE_MULTIPLE_REGISTERS,
+                                        _request_pdu(WRITE_MULTIPLE_REGISTERS, address,
+                                                     values=[int(value) for value in values]))
+
+
+traffic_capture = TrafficCapture(d["traffic_dir"])
+
+# Воспроизведение журнала вместо обмена со шлюзами, если задан replay_file
+replay_source = ReplaySource(d["replay_file"], d["replay_speed"]) if d.get("replay_file") else None
+
+
+# Запись обмена: POST /traffic?seconds=60 - начать, DELETE /traffic - остановить, GET /traffic - состояние
+class TrafficAPI(Resource):
+    def get(self):
+        return dict(traffic_capture.status(), replay=dict(replay_source.stats, file=replay_source.path)
+                    if replay_source else None)
+
+    def post(self):
+        parser = reqparse.RequestParser(bundle_errors=True)
+        parser.add_argument("seconds", type=float, location="args")
+        query = parser.parse_args()
+        try:
+            traffic_capture.start(seconds=query["seconds"])
+        except ValueError as e:
+            abort(409, message=str(e))
+        return traffic_capture.status(), 201
+
+    def delete(self):
+        traffic_capture.stop()
+        return traffic_capture.status()
+
+
+# Файл журнала: GET /traffic/<имя>
+class TrafficFileAPI(Resource):
+    def get(self, name):
+        if not name.endswith(".bin"):
+            abort(404, message=f"Нет журнала {name}")
+        return send_from_directory(os.path.abspath(traffic_capture.directory), name, as_attachment=True)
+
+
+api.add_resource(TrafficAPI, '/traffic')
+api.add_resource(TrafficFileAPI, '/traffic/<string:name>')
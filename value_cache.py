@@ -0,0 +1,57 @@
+import time
+from collections import namedtuple
+from datetime import datetime
+
+# Последнее значение параметра и время его получения (секунды Unix)
+Sample = namedtuple("Sample", ["value", "timestamp"])
+
+
+# Кэш последних значений параметров. Заполняется в цикле событий опроса,
+# читается из потоков Flask: отдельные операции со словарем атомарны, поэтому блокировка не нужна.
+# При работе в нескольких процессах значения хранятся в общей таблице shared_table.SharedTable:
+# процесс опроса пишет в нее, остальные процессы читают
+class ValueCache:
+    def __init__(self):
+        self._samples = {}
+        self._shared = None
+
+    def share(self, table):
+        for name, sample in self._samples.items():
+            if name in table.index:
+                table.write_param(name, sample.value, sample.timestamp)
+        self._shared = table
+
+    def update(self, param_name, value, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.time()
+        if self._shared is not None and param_name in self._shared.index:
+            self._shared.write_param(param_name, value, timestamp)
+        else:
+            self._samples[param_name] = Sample(value, timestamp)
+
+    # Значение, полученное не раньше чем max_age секунд назад, или None
+    def get(self, param_name, max_age):
+        if self._shared is not None and param_name in self._shared.index:
+            sample = self._shared.read_param(param_name)
+            sample = Sample(*sample) if sample else None
+        else:
+            sample = self._samples.get(param_name)
+        if sample is None or time.time() - sample.timestamp > max_age:
+            return None
+        return sample
+
+    def snapshot(self):
+        samples = dict(self._samples)
+        if self._shared is not None:
+            for name in self._shared.names:
+                sample = self._shared.read_param(name)
+                if sample:
+                    samples[name] = Sample(*sample)
+        return samples
+
+
+# Время получения значения в виде строки для ответа REST
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat(timespec="milliseconds")
+
+
+value_cache = ValueCache()
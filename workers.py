@@ -0,0 +1,193 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import struct
+import time
+from flask import Blueprint
+from device_profiles import device_params, device_labs
+from poll_schedule import deadband
+from shared_table import SharedTable
+from stream import broadcaster
+from value_cache import value_cache
+
+workers = Blueprint('workers', __name__)
+
+# Подгружаем настройки из файла
+with open('config.json') as f:
+    d = json.load(f)
+
+# Смена роли процесса пишется в журнал опроса
+logger = logging.getLogger("poll_params_logger")
+
+FRAME = struct.Struct("<I")
+
+
+# Кадр обмена между процессами: длина и заголовок JSON, затем тело длиной header["length"] байт
+async def _send_frame(writer, header, body=b""):
+    header = json.dumps(dict(header, length=len(body))).encode()
+    writer.write(FRAME.pack(len(header)) + header + body)
+    await writer.drain()
+
+
+async def _receive_frame(reader):
+    size = FRAME.unpack(await reader.readexactly(FRAME.size))[0]
+    header = json.loads(await reader.readexactly(size))
+    return header, await reader.readexactly(header["length"])
+
+
+# Роль процесса при запуске нескольких рабочих процессов сервера ASGI (uvicorn --workers n).
+# Опрос, обмен с приборами и запись в базы ведет один процесс - владелец блокировки файла worker_dir/poller.lock.
+# Он публикует значения и состояние устройств в общей таблице и принимает пересланные запросы
+# через сокет worker_dir/poller.sock. Остальные процессы читают таблицу, пересылают владельцу запросы,
+# требующие обмена с приборами, и занимают его место, если он завершился
+class WorkerRole:
+    def __init__(self, directory):
+        self.directory = directory
+        self.owner = False
+        self.table = SharedTable(os.path.join(directory, "values.shm"), device_params, device_labs)
+        self.forwarded = 0
+        self.forward_errors = 0
+        self._lock_file = None
+        self._server = None
+        self._task = None
+        self._on_owner = None
+        self._handler = None
+        self._shared = False
+        self._seen = {}
+
+    @property
+    def socket_path(self):
+        return os.path.join(self.directory, "poller.sock")
+
+    # Процесс работает как читающий: запросы к приборам нужно переслать владельцу
+    @property
+    def forwarding(self):
+        return self._task is not None and not self.owner
+
+    # on_owner вызывается, когда процесс становится владельцем (запуск опроса),
+    # handler(header, body) -> (status, headers, body) выполняет пересланный запрос
+    async def start(self, on_owner, handler):
+        self._on_owner = on_owner
+        self._handler = handler
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(os.path.join(self.directory, "poller.lock"), "a")
+        if not await self._try_acquire():
+            logger.info("Процесс %s работает без опроса, опрос ведет другой процесс", os.getpid())
+        self._task = asyncio.ensure_future(self._follow())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._lock_file is not None:
+            # Закрытие файла снимает блокировку, ее занимает один из оставшихся процессов
+            self._lock_file.close()
+            self._lock_file = None
+        self.owner = False
+
+    async def _try_acquire(self):
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self.table.create(os.getpid())
+        if not self._shared:
+            value_cache.share(self.table)
+            self._shared = True
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._serve, self.socket_path)
+        self.owner = True
+        logger.info("Процесс %s ведет опрос", os.getpid())
+        self._on_owner()
+        return True
+
+    # Читающий процесс: подключение к таблице, раздача новых значений подписчикам /stream
+    # и попытка занять место владельца
+    async def _follow(self):
+        while not self.owner:
+            await asyncio.sleep(d["worker_sync_seconds"])
+            if await self._try_acquire():
+                return
+            if not self._shared:
+                try:
+                    self.table.open()
+                except (OSError, ValueError):
+                    continue
+                value_cache.share(self.table)
+                self._shared = True
+            self._publish_new()
+
+    # Значения, полученные владельцем после прошлой проверки, уходят в поток по тем же правилам
+    # зоны нечувствительности, что и у владельца
+    def _publish_new(self):
+        samples = []
+        for name in self.table.names:
+            sample = self.table.read_param(name)
+            if sample and self._seen.get(name) != sample[1]:
+                self._seen[name] = sample[1]
+                samples.append((name, sample[0], sample[1]))
+        samples = deadband.filter(samples)
+        if samples:
+            broadcaster.publish(samples)
+
+    # Публикация состояния устройств владельцем после цикла опроса
+    def publish_status(self, device_status):
+        if self.owner:
+            timestamp = time.time()
+            for device, available in device_status.items():
+                self.table.write_device(device, available, timestamp)
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                header, body = await _receive_frame(reader)
+                status, headers, body = await self._handler(header, body)
+                await _send_frame(writer, {"status": status, "headers": headers}, body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # Пересылка запроса владельцу: (status, headers, body)
+    async def forward(self, header, body=b""):
+        self.forwarded += 1
+        writer = None
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            await _send_frame(writer, header, body)
+            answer, body = await asyncio.wait_for(_receive_frame(reader), d["service_request_timeout"] + 1)
+            return answer["status"], answer["headers"], body
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            self.forward_errors += 1
+            body = (json.dumps({"message": "Нет связи с процессом опроса"}) + "\n").encode()
+            return 503, [["content-type", "application/json"]], body
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def status(self):
+        devices = {}
+        if self._shared:
+            for device in self.table.devices:
+                sample = self.table.read_device(device)
+                devices[device] = {"available": sample[0], "ts": sample[1]} if sample else None
+        return {"pid": os.getpid(), "owner": self.owner,
+                "owner_pid": self.table.owner_pid if self._shared else None,
+                "forwarded": self.forwarded, "forward_errors": self.forward_errors, "devices": devices}
+
+
+worker_role = WorkerRole(d["worker_dir"])
+
+
+# Роль процесса, обработавшего запрос, и состояние устройств из общей таблицы
+@workers.route('/stats/worker')
+def worker_stats():
+    return worker_role.status()
@@ -0,0 +1,157 @@
+import asyncio
+import itertools
+import time
+from locks import device_locks
+from modbus_pool import device_pool, PRIORITY_NORMAL
+from read_plan import RequestMetrics
+from rtt_estimator import device_rtts
+
+
+# Устройство ответило на запись ошибкой
+class WriteError(Exception):
+    pass
+
+
+# Код функции записи нескольких регистров
+WRITE_REGISTERS = 16
+
+# Метрики записи по slave_id: получаются при первой записи в устройство, дальше используются готовыми
+_write_metrics = {}
+
+
+# Запись одного значения в регистр с учетом времени запроса в метриках. Запись в энергонезависимую память
+# прибора бывает дольше чтения, поэтому ответ ждется до верхнего предела таймаута устройства.
+# Шина RTU ограничивает ожидание ответа сама, без учета времени в своей очереди
+async def write_register(client, device, slave_id, register, value):
+    metrics = _write_metrics.get(slave_id)
+    if metrics is None:
+        metrics = _write_metrics[slave_id] = RequestMetrics(slave_id, WRITE_REGISTERS)
+    started = time.perf_counter()
+    try:
+        call = client.write_registers(address=register, values=[value], slave=slave_id)
+        result = await (call if getattr(client, "enforces_timeout", False)
+                        else asyncio.wait_for(call, timeout=device_rtts[device].ceiling))
+    except asyncio.TimeoutError:
+        metrics.timeouts.inc()
+        raise
+    except Exception:
+        metrics.exceptions.inc()
+        raise
+    metrics.seconds.observe(time.perf_counter() - started)
+    if result.isError():
+        metrics.errors.inc()
+        raise WriteError(f"Ошибка записи в регистр {register} устройства {slave_id}: {result}")
+    return result
+
+
+# Выполнение шагов команды на одном устройстве: ("write", slave_id, регистр, значение) или ("delay", секунды).
+# Блокировка устройства держится все время, поэтому опрос и другие команды не вклиниваются между шагами.
+# after_write вызывается после каждой записи
+async def execute_steps(device, steps, priority=PRIORITY_NORMAL, after_write=None):
+    async with device_locks[device]:
+        for step in steps:
+            if step[0] == "delay":
+                await asyncio.sleep(step[1])
+                continue
+            _, slave_id, register, value = step
+            async with device_pool(device).connection(priority=priority) as client:
+                await write_register(client, device, slave_id, register, value)
+            if after_write is not None:
+                after_write()
+
+
+# Очередь команд записи на устройства. У каждого прибора своя очередь и свой обработчик: команды прибора
+# выполняются по одной в порядке приоритета и не ждут команд других приборов. Срочные (приоритет меньше
+# PRIORITY_NORMAL) выполняются отдельным общим обработчиком, чтобы аварийные действия не ждали окончания
+# обычных команд. Работает только в цикле событий modbus_service
+class WriteQueue:
+    def __init__(self):
+        self._queues = {}   # "urgent" или прибор -> asyncio.PriorityQueue
+        self._workers = {}
+        self._order = itertools.count()
+        self._coalescing = {}  # (прибор, регистр) -> запись, еще не отправленная на устройство
+        self.stats = {
+            "urgent": {"executed": 0, "failed": 0, "coalesced": 0, "max_wait_seconds": 0.0},
+            "normal": {"executed": 0, "failed": 0, "coalesced": 0, "max_wait_seconds": 0.0}
+        }
+
+    def _queue(self, lane):
+        if lane not in self._workers or self._workers[lane].done():
+            self._queues[lane] = asyncio.PriorityQueue()
+            self._workers[lane] = asyncio.ensure_future(self._work(lane))
+        return self._queues[lane]
+
+    # Постановка команды в очередь прибора device (без прибора - в общую очередь "normal").
+    # job - функция без аргументов, возвращающая корутину. Возвращает future с результатом команды
+    def submit(self, job, priority=PRIORITY_NORMAL, device=None):
+        lane = "urgent" if priority < PRIORITY_NORMAL else (device or "normal")
+        future = asyncio.get_running_loop().create_future()
+        self._queue(lane).put_nowait((priority, next(self._order), time.monotonic(), job, future))
+        return future
+
+    # Запись значения в регистр. Если запись в тот же регистр еще ждет очереди, она получает новое
+    # значение, а отдельная запись не создается. Все запросившие получают записанное значение
+    async def write(self, device, slave_id, register, value, priority=PRIORITY_NORMAL):
+        key = (device, register)
+        entry = self._coalescing.get(key)
+        if entry is not None:
+            entry["value"] = value
+            entry["requests"] += 1
+            self.stats["urgent" if priority < PRIORITY_NORMAL else "normal"]["coalesced"] += 1
+        else:
+            entry = self._coalescing[key] = {"value": value, "requests": 1}
+
+            async def job():
+                # С этого момента новые записи в регистр пойдут отдельной командой
+                if self._coalescing.get(key) is entry:
+                    del self._coalescing[key]
+                applied = entry["value"]
+                await execute_steps(device, [("write", slave_id, register, applied)], priority)
+                return {"register": register, "value": applied, "requests": entry["requests"]}
+
+            entry["future"] = self.submit(job, priority, device)
+        # Отмена ожидания одним запросившим не должна отменять запись для остальных
+        return await asyncio.shield(entry["future"])
+
+    # Последовательность шагов на одном устройстве одной командой: другие команды прибора
+    # и его опрос не выполняются между ее шагами
+    async def transaction(self, device, steps, priority=PRIORITY_NORMAL):
+        return await asyncio.shield(self.submit(lambda: execute_steps(device, steps, priority), priority, device))
+
+    async def _work(self, lane):
+        queue = self._queues[lane]
+        stats = self.stats["urgent" if lane == "urgent" else "normal"]
+        while True:
+            priority, _, queued, job, future = await queue.get()
+            if future.cancelled():
+                continue
+            stats["max_wait_seconds"] = round(max(stats["max_wait_seconds"], time.monotonic() - queued), 3)
+            try:
+                result = await job()
+            except Exception as e:
+                stats["failed"] += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                stats["executed"] += 1
+                if not future.done():
+                    future.set_result(result)
+
+    # Остановка обработчиков при остановке цикла событий; невыполненные команды отменяются
+    async def close(self):
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for queue in self._queues.values():
+            while not queue.empty():
+                queue.get_nowait()[-1].cancel()
+        self._workers.clear()
+        self._queues.clear()
+
+    @property
+    def pending(self):
+        return {lane: queue.qsize() for lane, queue in self._queues.items()}
+
+
+write_queue = WriteQueue()